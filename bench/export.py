@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from typing import Dict, List
+
+from bench.synthetic import add_arguments, synthetic_image
+from podracer.export import Image, export_layers
+
+
+class CountingOutput:
+  def __init__(self):
+    self.bytes = 0
+
+
+  def write(self, data: bytes) -> int:
+    self.bytes += len(data)
+    return len(data)
+
+
+  def close(self) -> None:
+    pass
+
+
+def reset_peak_rss() -> bool:
+  # Linux lets a process reset its own high water mark
+  try:
+    with open('/proc/self/clear_refs', 'w') as io:
+      io.write('5')
+    return True
+  except OSError:
+    return False
+
+
+def peak_rss() -> int:
+  try:
+    with open('/proc/self/status') as io:
+      for line in io:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+
+  # Peak of the whole process, including generating the archive
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(archive: str, path: str = None) -> Dict[str, float]:
+  reset_peak_rss()
+
+  start = time.monotonic()
+  image = Image(archive=archive)
+  opened = time.monotonic()
+
+  # A real file lets export_layers have the kernel copy file bodies
+  output = CountingOutput() if path is None else open(path, 'wb')
+  export_layers(image.layers, output)
+  exported = time.monotonic()
+
+  size = output.bytes if path is None else os.path.getsize(path) if os.path.isfile(path) else 0
+
+  return {
+    'image_seconds': opened - start,
+    'export_seconds': exported - opened,
+    'seconds': exported - start,
+    'input_files': sum(len(layer.files) for layer in image.layers),
+    'output_bytes': size,
+    'peak_rss_bytes': peak_rss(),
+  }
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Measure export_rootfs against a synthetic or saved image, without podman')
+  parser.add_argument('--input', metavar='PATH', help='use a docker-archive saved earlier instead of generating one')
+  parser.add_argument('--output', metavar='PATH', help='write the export to PATH instead of counting it in Python')
+  parser.add_argument('--repeat', metavar='N', type=int, default=3, help='runs to take the median of')
+  parser.add_argument('--json', action='store_true', help='print the results as a JSON object')
+  add_arguments(parser)
+  args = parser.parse_args(argv)
+
+  archive = args.input
+  if archive is None:
+    with tempfile.NamedTemporaryFile(suffix='.tar', delete=False) as io:
+      synthetic_image(io, args)
+    archive = io.name
+
+  try:
+    runs = [measure(archive, args.output) for _ in range(args.repeat)]
+  finally:
+    if args.input is None:
+      os.unlink(archive)
+
+  result = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+  result['peak_rss_bytes'] = max(run['peak_rss_bytes'] for run in runs)
+  result['files_per_second'] = result['input_files'] / result['seconds']
+  result['output_mb_per_second'] = result['output_bytes'] / result['export_seconds'] / 1e6
+  if args.input is None:
+    result['parameters'] = {key: getattr(args, key) for key in ['layers', 'files', 'depth', 'width', 'sizes', 'whiteouts', 'opaque', 'seed']}
+
+  if args.json:
+    print(json.dumps(result))
+    return 0
+
+  for key in ['image_seconds', 'export_seconds', 'seconds', 'files_per_second', 'output_mb_per_second']:
+    print(f"{key:>22} {result[key]:>14.3f}")
+  for key in ['input_files', 'output_bytes', 'peak_rss_bytes']:
+    print(f"{key:>22} {int(result[key]):>14}")
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
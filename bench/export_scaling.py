@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+import tarfile
+import time
+
+from io import BytesIO
+from typing import IO, List
+
+from podracer.export import Layer, export_layers
+
+
+def synthetic_layer(files: int) -> IO[bytes]:
+  layer = BytesIO()
+  with tarfile.open(mode='w', fileobj=layer) as tarball:
+    for index in range(files):
+      member = tarfile.TarInfo(f"usr/share/bench/{index % 100:02}/{index}")
+      content = str(index).encode()
+      member.size = len(content)
+      tarball.addfile(member, BytesIO(content))
+
+  layer.seek(0)
+  return layer
+
+
+def measure(files: int) -> float:
+  buffer = synthetic_layer(files)
+  start = time.monotonic()
+  export_layers([Layer(buffer, 'layer.tar')], open(os.devnull, 'wb'))
+  return time.monotonic() - start
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Measure how export time scales with layer file count')
+  parser.add_argument('--files', metavar='N', type=int, default=25000, help='file count of the smallest layer')
+  parser.add_argument('--steps', metavar='N', type=int, default=4, help='number of times to double the file count')
+  args = parser.parse_args(argv)
+
+  print(f"{'files':>10} {'seconds':>10} {'us/file':>10}")
+  for step in range(args.steps):
+    files = args.files * (2 ** step)
+    elapsed = measure(files)
+    print(f"{files:>10} {elapsed:>10.3f} {elapsed / files * 1e6:>10.2f}")
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,298 @@
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import re
+import secrets
+import socket
+import sys
+import tarfile
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from podracer.registry import IMAGE_TYPE, MANIFEST_LIST_TYPE, MANIFEST_V2_TYPE
+
+LAYER_TYPE = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+TOKEN_LIFETIME = 300
+
+
+def sha256_digest(data: bytes) -> str:
+  return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+def synthetic_layer(rng: random.Random, files: int, size: int) -> bytes:
+  layer = BytesIO()
+  with tarfile.open(mode='w', fileobj=layer) as tarball:
+    for index in range(files):
+      member = tarfile.TarInfo(f"usr/share/fake/{index % 16:x}/{rng.getrandbits(64):016x}")
+      member.size = size
+      # Not randbytes, which is new in 3.9; getrandbits(0) fails before then
+      tarball.addfile(member, BytesIO(rng.getrandbits(8 * size).to_bytes(size, 'little') if size > 0 else b''))
+  return layer.getvalue()
+
+
+class FakeRegistry:
+  # Just enough of a registry, and its token service, to exercise
+  # podracer.registry offline; counts every request it answers by kind.
+  # drop_rate is the fraction of blob responses cut off partway through
+  def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0, token_lifetime: int = TOKEN_LIFETIME, drop_rate: float = 0.0):
+    self.latency = latency
+    self.error_rate = error_rate
+    self.drop_rate = drop_rate
+    self.token_lifetime = token_lifetime
+    self.rng = random.Random(seed)
+
+    self.lock = threading.Lock()
+    self.blobs: Dict[str, bytes] = {}
+    self.manifests: Dict[Tuple[str, str], Tuple[str, bytes]] = {}
+    self.tokens: Dict[str, Tuple[str, float]] = {}
+    self.stats: Counter = Counter()
+
+
+  def add_blob(self, data: bytes) -> str:
+    digest = sha256_digest(data)
+    self.blobs[digest] = data
+    return digest
+
+
+  def add_manifest(self, repository: str, content_type: str, body: dict, tag: str = None) -> Tuple[str, int]:
+    data = json.dumps(body).encode()
+    digest = sha256_digest(data)
+    self.manifests[(repository, digest)] = (content_type, data)
+    if tag is not None:
+      self.manifests[(repository, tag)] = (content_type, data)
+    return digest, len(data)
+
+
+  def add_image(self, repository: str, tag: str, platforms: List[str] = ['amd64'], layers: int = 3, files: int = 10, size: int = 1024) -> None:
+    # More than one platform gets a manifest list, like most images on Docker Hub
+    entries = []
+    for platform in platforms:
+      architecture, _, variant = platform.partition('/')
+
+      layer_entries = []
+      diff_ids = []
+      for _ in range(layers):
+        layer = synthetic_layer(self.rng, files, size)
+        blob = gzip.compress(layer)
+        layer_entries.append({'mediaType': LAYER_TYPE, 'size': len(blob), 'digest': self.add_blob(blob)})
+        diff_ids.append(sha256_digest(layer))
+
+      config = {'architecture': architecture, 'os': 'linux', 'config': {'Env': ['PATH=/usr/bin:/bin'], 'Cmd': ['/bin/sh']}, 'rootfs': {'type': 'layers', 'diff_ids': diff_ids}}
+      if len(variant) > 0:
+        config['variant'] = variant
+      config_data = json.dumps(config).encode()
+
+      manifest = {
+        'schemaVersion': 2,
+        'mediaType': MANIFEST_V2_TYPE,
+        'config': {'mediaType': IMAGE_TYPE, 'size': len(config_data), 'digest': self.add_blob(config_data)},
+        'layers': layer_entries,
+      }
+      digest, length = self.add_manifest(repository, MANIFEST_V2_TYPE, manifest, tag if len(platforms) == 1 else None)
+
+      entry = {'mediaType': MANIFEST_V2_TYPE, 'size': length, 'digest': digest, 'platform': {'architecture': architecture, 'os': 'linux'}}
+      if len(variant) > 0:
+        entry['platform']['variant'] = variant
+      entries.append(entry)
+
+    if len(platforms) > 1:
+      self.add_manifest(repository, MANIFEST_LIST_TYPE, {'schemaVersion': 2, 'mediaType': MANIFEST_LIST_TYPE, 'manifests': entries}, tag)
+
+
+  def issue_token(self, scope: str) -> str:
+    token = secrets.token_hex(16)
+    with self.lock:
+      self.tokens[token] = (scope, time.monotonic() + self.token_lifetime)
+    return token
+
+
+  def authorized(self, header: Optional[str], repository: str) -> bool:
+    if header is None or not header.startswith('Bearer '):
+      return False
+
+    with self.lock:
+      scope, expires = self.tokens.get(header[7:], ('', 0.0))
+    return time.monotonic() < expires and scope == f"repository:{repository}:pull"
+
+
+  def count(self, kind: str) -> None:
+    with self.lock:
+      self.stats[kind] += 1
+
+
+  def snapshot(self) -> Dict[str, int]:
+    with self.lock:
+      return dict(self.stats)
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format: str, *args) -> None:
+    pass
+
+
+  def reply(self, status: int, body: bytes = b'', headers: Dict[str, str] = {}, drop: int = None) -> None:
+    # drop, if given, is how much of the body to send before hanging up
+    self.send_response(status)
+    for key, value in headers.items():
+      self.send_header(key, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if self.command == 'HEAD':
+      return
+
+    if drop is None:
+      self.wfile.write(body)
+      return
+
+    self.wfile.write(body[:drop])
+    self.wfile.flush()
+    self.connection.shutdown(socket.SHUT_RDWR)
+    self.close_connection = True
+
+
+  def reply_blob(self, registry: FakeRegistry, digest: str) -> None:
+    blob = registry.blobs.get(digest)
+    if blob is None:
+      self.reply(404)
+      return
+
+    status = 200
+    headers = {'Content-Type': 'application/octet-stream', 'Docker-Content-Digest': digest}
+    start, end = 0, len(blob)
+
+    match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers['Range'] or '')
+    if match is not None:
+      start = int(match.group(1))
+      if len(match.group(2)) > 0:
+        end = min(int(match.group(2)) + 1, len(blob))
+      if start >= end:
+        self.reply(416, headers={'Content-Range': f"bytes */{len(blob)}"})
+        return
+      status = 206
+      headers['Content-Range'] = f"bytes {start}-{end - 1}/{len(blob)}"
+
+    drop = None
+    if self.command == 'GET' and end - start > 1 and registry.rng.random() < registry.drop_rate:
+      registry.count('dropped')
+      drop = registry.rng.randrange(end - start)
+
+    self.reply(status, blob[start:end], headers, drop)
+
+
+  def do_GET(self) -> None:
+    registry: FakeRegistry = self.server.registry
+    url = urlparse(self.path)
+
+    if url.path == '/stats':
+      self.reply(200, json.dumps(registry.snapshot()).encode(), {'Content-Type': 'application/json'})
+      return
+
+    time.sleep(registry.latency)
+    if registry.rng.random() < registry.error_rate:
+      registry.count('error')
+      self.reply(503, b'injected error')
+      return
+
+    if url.path == '/token':
+      registry.count('token')
+      scope = parse_qs(url.query).get('scope', [''])[0]
+      body = {'token': registry.issue_token(scope), 'expires_in': registry.token_lifetime}
+      self.reply(200, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+      return
+
+    match = re.match(r'^/v2/(.+)/(manifests|blobs)/([^/]+)$', url.path)
+    if match is None:
+      self.reply(404)
+      return
+    repository, kind, reference = match.groups()
+
+    if not registry.authorized(self.headers['Authorization'], repository):
+      registry.count('unauthorized')
+      realm = f"http://{self.headers['Host']}/token"
+      self.reply(401, headers={'Www-Authenticate': f'Bearer realm="{realm}",service="fake-registry",scope="repository:{repository}:pull"'})
+      return
+
+    registry.count(f"{self.command.lower()} {kind}")
+
+    if kind == 'blobs':
+      self.reply_blob(registry, reference)
+      return
+
+    if (repository, reference) not in registry.manifests:
+      self.reply(404)
+      return
+
+    content_type, body = registry.manifests[(repository, reference)]
+    digest = sha256_digest(body)
+    if self.headers['If-None-Match'] == f'"{digest}"':
+      self.reply(304, headers={'Docker-Content-Digest': digest, 'ETag': f'"{digest}"'})
+      return
+    self.reply(200, body, {'Content-Type': content_type, 'Docker-Content-Digest': digest, 'ETag': f'"{digest}"'})
+
+
+  do_HEAD = do_GET
+
+
+class FakeRegistryServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, registry: FakeRegistry, address: Tuple[str, int] = ('127.0.0.1', 0)):
+    self.registry = registry
+    super().__init__(address, FakeRegistryHandler)
+
+
+  @property
+  def host(self) -> str:
+    return f"{self.server_address[0]}:{self.server_address[1]}"
+
+
+  def start(self) -> threading.Thread:
+    thread = threading.Thread(target=self.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+  parser.add_argument('--images', metavar='N', type=int, default=10, help='images to serve')
+  parser.add_argument('--platforms', metavar='ARCH[/VARIANT],...', default='amd64,arm64/v8', help='platforms of each image; more than one serves a manifest list')
+  parser.add_argument('--layers', metavar='N', type=int, default=3, help='layers in each image')
+  parser.add_argument('--files', metavar='N', type=int, default=10, help='files in each layer')
+  parser.add_argument('--file-size', metavar='BYTES', type=int, default=1024, help='size of each file')
+  parser.add_argument('--latency', metavar='SECONDS', type=float, default=0.0, help='delay before answering each request')
+  parser.add_argument('--error-rate', metavar='FRACTION', type=float, default=0.0, help='fraction of requests to answer with 503')
+  parser.add_argument('--drop-rate', metavar='FRACTION', type=float, default=0.0, help='fraction of blob downloads to hang up on partway through')
+  parser.add_argument('--token-lifetime', metavar='SECONDS', type=int, default=TOKEN_LIFETIME, help=f"how long tokens are valid for (default {TOKEN_LIFETIME})")
+  parser.add_argument('--seed', metavar='N', type=int, default=0, help='random seed for content and errors')
+
+
+def populate(args: argparse.Namespace) -> FakeRegistry:
+  registry = FakeRegistry(args.latency, args.error_rate, args.seed, args.token_lifetime, args.drop_rate)
+  for index in range(args.images):
+    registry.add_image(f"bench/image{index}", 'latest', args.platforms.split(','), args.layers, args.files, args.file_size)
+  return registry
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Serve synthetic images over the registry v2 API, for testing and benchmarking')
+  parser.add_argument('--port', metavar='PORT', type=int, default=5000, help='port to listen on')
+  add_arguments(parser)
+  args = parser.parse_args(argv)
+
+  server = FakeRegistryServer(populate(args), ('127.0.0.1', args.port))
+  sys.stderr.write(f"Serving bench/image0..{args.images - 1}:latest on {server.host}; set PODRACER_INSECURE_REGISTRIES={server.host}\n")
+  server.serve_forever()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
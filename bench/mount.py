@@ -0,0 +1,56 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import List
+
+from podracer.poststop import LIBC, mount, umount
+
+
+def measure(root: Path, count: int, helper: bool) -> float:
+  lowerdir = root.joinpath('lower')
+  mountpoint = root.joinpath('rootfs')
+  for directory in [lowerdir, mountpoint]:
+    directory.mkdir(exist_ok=True)
+
+  start = time.monotonic()
+  for index in range(count):
+    upperdir = root.joinpath(f"upper.{index}")
+    workdir = root.joinpath(f"work.{index}")
+    upperdir.mkdir()
+    workdir.mkdir()
+    mount('overlay', 'overlay', mountpoint, f"lowerdir={lowerdir},upperdir={upperdir},workdir={workdir}", helper)
+    umount(mountpoint, helper)
+  return time.monotonic() - start
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Compare overlay mount and unmount through libc against mount(8) and umount(8)')
+  parser.add_argument('--count', metavar='N', type=int, default=200, help='mount/unmount cycles per method')
+  args = parser.parse_args(argv)
+
+  if os.geteuid() != 0:
+    raise RuntimeError('Mounting overlays needs root')
+
+  methods = [('mount(8)', True)]
+  if LIBC is not None:
+    methods.append(('mount(2)', False))
+
+  print(f"{'method':>10} {'seconds':>10} {'ms/cycle':>10}")
+  for name, helper in methods:
+    root = Path(tempfile.mkdtemp())
+    try:
+      elapsed = measure(root, args.count, helper)
+    finally:
+      shutil.rmtree(root)
+    print(f"{name:>10} {elapsed:>10.3f} {elapsed / args.count * 1e3:>10.2f}")
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
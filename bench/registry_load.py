@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from bench.fake_registry import FakeRegistryServer, add_arguments, populate
+from podracer.registry import MANIFEST_JOBS
+
+
+def run_commands(commands: List[List[str]], env: Dict[str, str], concurrency: int) -> int:
+  def run(argv: List[str]) -> int:
+    return subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    return sum(1 for status in executor.map(run, commands) if status != 0)
+
+
+def measure(name: str, server: FakeRegistryServer, commands: List[List[str]], env: Dict[str, str], concurrency: int, images: int = None) -> dict:
+  images = images or len(commands)
+  before = Counter(server.registry.snapshot())
+  start = time.monotonic()
+  failures = run_commands(commands, env, concurrency)
+  elapsed = time.monotonic() - start
+  requests = Counter(server.registry.snapshot()) - before
+
+  return {
+    'command': name,
+    'images': images,
+    'failures': failures,
+    'seconds': elapsed,
+    'seconds_per_image': elapsed / images,
+    'requests': sum(requests.values()),
+    'requests_per_image': sum(requests.values()) / images,
+    'requests_by_kind': dict(requests),
+  }
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Measure podracer-manifests and podracer-repack against a local fake registry')
+  parser.add_argument('--concurrency', metavar='N', type=int, default=1, help='commands to run at once')
+  parser.add_argument('--jobs', metavar='N', type=int, default=MANIFEST_JOBS, help=f"images the single podracer-manifests run inspects at once (default {MANIFEST_JOBS})")
+  parser.add_argument('--arch', metavar='ARCH', default='amd64', help='architecture to repack')
+  parser.add_argument('--repack', action='store_true', help='also run podracer-repack for each image; needs ostree')
+  parser.add_argument('--json', action='store_true', help='print one JSON object per command')
+  add_arguments(parser)
+  args = parser.parse_args(argv)
+
+  server = FakeRegistryServer(populate(args))
+  server.start()
+
+  scratch = tempfile.mkdtemp()
+  env = dict(os.environ, PODRACER_INSECURE_REGISTRIES=server.host, PODRACER_LIBDIR=scratch, HOME=scratch)
+  images = [f"{server.host}/bench/image{index}:latest" for index in range(args.images)]
+
+  try:
+    results = [measure('podracer-manifests', server, [[sys.executable, '-m', 'podracer.manifests', image] for image in images], env, args.concurrency)]
+    # And all of them from one process, which overlaps the round trips
+    results.append(measure('podracer-manifests (all)', server, [[sys.executable, '-m', 'podracer.manifests', '--jobs', str(args.jobs)] + images], env, 1, len(images)))
+
+    if args.repack:
+      if shutil.which('ostree') is None:
+        sys.stderr.write("NOTICE: ostree not found, skipping podracer-repack\n")
+      else:
+        repo = os.path.join(scratch, 'repo')
+        subprocess.run(['ostree', f"--repo={repo}", 'init', '--mode=archive-z2'], check=True)
+        commands = [[sys.executable, '-m', 'podracer.repack', '--repo', repo, '--arch', args.arch, f"bench/image{index}", image] for index, image in enumerate(images)]
+        results.append(measure('podracer-repack', server, commands, env, args.concurrency))
+  finally:
+    server.shutdown()
+    shutil.rmtree(scratch)
+
+  for result in results:
+    if args.json:
+      print(json.dumps(result))
+      continue
+
+    print(f"{result['command']}: {result['images']} images ({result['failures']} failed) in {result['seconds']:.3f}s, {result['seconds_per_image']:.3f}s and {result['requests_per_image']:.1f} requests per image")
+    for kind, count in sorted(result['requests_by_kind'].items()):
+      print(f"  {kind:>16} {count:>8}")
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,121 @@
+import argparse
+import hashlib
+import json
+import random
+import sys
+import tarfile
+
+from io import BytesIO
+from typing import IO, List, Tuple
+
+from podracer.cache import parse_size
+
+DEFAULT_SIZES = '0:20,512:40,4K:30,64K:9,1M:1'
+
+
+def parse_sizes(sizes: str) -> Tuple[List[int], List[float]]:
+  # SIZE:WEIGHT pairs, e.g. 4K:30,1M:1
+  values = []
+  weights = []
+  for pair in sizes.split(','):
+    size, _, weight = pair.partition(':')
+    values.append(parse_size(size))
+    weights.append(float(weight) if len(weight) > 0 else 1.0)
+  return values, weights
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+  parser.add_argument('--layers', metavar='N', type=int, default=5, help='layers in the image')
+  parser.add_argument('--files', metavar='N', type=int, default=10000, help='files added by each layer')
+  parser.add_argument('--depth', metavar='N', type=int, default=4, help='directory depth of each file')
+  parser.add_argument('--width', metavar='N', type=int, default=8, help='subdirectories of each directory')
+  parser.add_argument('--sizes', metavar='SIZE:WEIGHT,...', default=DEFAULT_SIZES, help=f"file size distribution (default {DEFAULT_SIZES})")
+  parser.add_argument('--whiteouts', metavar='FRACTION', type=float, default=0.05, help='whiteouts per file added, for files in lower layers')
+  parser.add_argument('--opaque', metavar='FRACTION', type=float, default=0.01, help='opaque markers per file added, for directories in lower layers')
+  parser.add_argument('--seed', metavar='N', type=int, default=0, help='random seed, so runs are comparable')
+
+
+def add_member(tarball: tarfile.TarFile, name: str, size: int = 0, directory: bool = False) -> None:
+  member = tarfile.TarInfo(name)
+  if directory:
+    member.type = tarfile.DIRTYPE
+    member.mode = 0o755
+    tarball.addfile(member)
+    return
+
+  member.size = size
+  tarball.addfile(member, BytesIO(b'\xa5' * size) if size > 0 else None)
+
+
+def synthetic_layer(rng: random.Random, index: int, lower: List[str], lower_dirs: List[str], args: argparse.Namespace) -> Tuple[BytesIO, List[str], List[str]]:
+  sizes, weights = parse_sizes(args.sizes)
+  files = []
+  directories = set()
+
+  layer = BytesIO()
+  with tarfile.open(mode='w', fileobj=layer) as tarball:
+    for number in range(args.files):
+      parts = [f"d{rng.randrange(args.width)}" for _ in range(args.depth)]
+      for level in range(1, len(parts) + 1):
+        directory = '/'.join(parts[:level])
+        if directory not in directories:
+          directories.add(directory)
+          add_member(tarball, directory, directory=True)
+
+      filename = '/'.join(parts + [f"layer{index}-{number}"])
+      add_member(tarball, filename, rng.choices(sizes, weights)[0])
+      files.append(filename)
+
+    if len(lower) > 0:
+      for filename in rng.sample(lower, min(len(lower), int(args.files * args.whiteouts))):
+        parent, slash, basename = filename.rpartition('/')
+        add_member(tarball, f"{parent}{slash}.wh.{basename}")
+
+    if len(lower_dirs) > 0:
+      for directory in rng.sample(lower_dirs, min(len(lower_dirs), int(args.files * args.opaque))):
+        add_member(tarball, f"{directory}/.wh..wh..opq")
+
+  layer.seek(0)
+  return layer, files, sorted(directories)
+
+
+def synthetic_image(output: IO[bytes], args: argparse.Namespace) -> None:
+  # Writes a docker-archive, like podman save would
+  rng = random.Random(args.seed)
+  lower: List[str] = []
+  lower_dirs: List[str] = []
+  layer_names = []
+
+  with tarfile.open(mode='w|', fileobj=output) as archive:
+    for index in range(args.layers):
+      layer, files, directories = synthetic_layer(rng, index, lower, lower_dirs, args)
+      name = f"{hashlib.sha256(layer.getbuffer()).hexdigest()}/layer.tar"
+      layer_names.append(name)
+
+      member = tarfile.TarInfo(name)
+      member.size = len(layer.getbuffer())
+      archive.addfile(member, layer)
+
+      lower += files
+      lower_dirs += directories
+
+    manifest = json.dumps([{'Config': 'config.json', 'RepoTags': ['localhost/synthetic:latest'], 'Layers': layer_names}]).encode()
+    member = tarfile.TarInfo('manifest.json')
+    member.size = len(manifest)
+    archive.addfile(member, BytesIO(manifest))
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Generate a synthetic docker-archive for benchmarking')
+  parser.add_argument('output', metavar='PATH', help='where to write the archive')
+  add_arguments(parser)
+  args = parser.parse_args(argv)
+
+  with open(args.output, 'wb') as output:
+    synthetic_image(output, args)
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
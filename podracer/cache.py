@@ -0,0 +1,169 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, List, Optional
+from podracer.paths import PODRACER_LIBDIR
+
+LAYER_CACHE_DIR = PODRACER_LIBDIR.joinpath('layers')
+LAYER_CACHE_SIZE = os.environ.get('PODRACER_CACHE_SIZE', '10G')
+MANIFEST_CACHE_DIR = PODRACER_LIBDIR.joinpath('manifests')
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+  size = size.strip().upper().rstrip('B')
+  if len(size) > 0 and size[-1] in SIZE_SUFFIXES:
+    return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+  return int(size)
+
+
+class LayerCache:
+  # Uncompressed layer tarballs, keyed by the digest of the blob they were
+  # pulled from; modification times are bumped on use to track recency
+  def __init__(self, root: Path = LAYER_CACHE_DIR, max_size: int = None):
+    self.root = root
+    self.max_size = max_size if max_size is not None else parse_size(LAYER_CACHE_SIZE)
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+    self.root.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+
+  def path(self, digest: str) -> Path:
+    algorithm, hexdigest = digest.split(':', 1)
+    return self.root.joinpath(algorithm, hexdigest)
+
+
+  def open(self, digest: str) -> Optional[IO[bytes]]:
+    path = self.path(digest)
+
+    try:
+      buffer = open(path, 'rb')
+    except FileNotFoundError:
+      with self.lock:
+        self.misses += 1
+      return None
+
+    os.utime(path)
+    with self.lock:
+      self.hits += 1
+    return buffer
+
+
+  @contextmanager
+  def partial(self, digest: str) -> Iterator[Optional[IO[bytes]]]:
+    # The compressed blob, as far as an earlier download got before it was
+    # interrupted; removed once a download succeeds. None if another
+    # download of the same blob has it
+    path = self.path(digest)
+    path = path.with_name(path.name + '.partial')
+    path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+    buffer = open(path, 'a+b')
+    try:
+      fcntl.flock(buffer.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      buffer.close()
+      buffer = None
+
+    if buffer is None:
+      yield None
+      return
+
+    try:
+      yield buffer
+    except:
+      buffer.close()
+      raise
+
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      pass
+    buffer.close()
+
+
+  @contextmanager
+  def store(self, digest: str) -> Iterator[IO[bytes]]:
+    path = self.path(digest)
+    path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+    buffer = tempfile.NamedTemporaryFile(dir=path.parent, prefix='.', suffix='.tmp', delete=False)
+    try:
+      yield buffer
+      buffer.flush()
+      os.rename(buffer.name, path)
+    except:
+      buffer.close()
+      os.unlink(buffer.name)
+      raise
+
+    buffer.seek(0)
+
+
+  def prune(self) -> int:
+    entries = []
+    for directory in self.root.iterdir():
+      if not directory.is_dir():
+        continue
+      for entry in os.scandir(directory):
+        if entry.is_file() and not entry.name.startswith('.'):
+          stat = entry.stat()
+          entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+
+    # Interrupted downloads first, then least recently used
+    for _, size, path in sorted(entries, key=lambda entry: (not entry[2].endswith('.partial'), entry[0])):
+      if total <= self.max_size:
+        break
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+      removed += 1
+
+    return removed
+
+
+class ManifestCache:
+  # The last manifests we resolved for each image reference, along with the
+  # digest and ETag they were served with, so an unchanged tag can be
+  # recognized without downloading it again
+  def __init__(self, root: Path = MANIFEST_CACHE_DIR):
+    self.root = root
+    self.root.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+
+  def path(self, image: str) -> Path:
+    return self.root.joinpath(hashlib.sha256(image.encode()).hexdigest() + '.json')
+
+
+  def load(self, image: str) -> Optional[dict]:
+    try:
+      with open(self.path(image)) as io:
+        entry = json.load(io)
+    except (FileNotFoundError, ValueError):
+      return None
+
+    if entry.get('image') != image:
+      return None
+    return entry
+
+
+  def save(self, image: str, manifests: List[dict], digest: Optional[str], etag: Optional[str]) -> None:
+    entry = {'image': image, 'digest': digest, 'etag': etag, 'manifests': manifests}
+
+    with tempfile.NamedTemporaryFile('w', dir=self.root, prefix='.', suffix='.tmp', delete=False) as io:
+      json.dump(entry, io)
+    os.rename(io.name, self.path(image))
@@ -0,0 +1,41 @@
+import argparse
+import json
+import sys
+
+from podracer.ostree import CHECKOUT_GRACE, CHECKOUT_KEEP, ostree_gc
+from podracer.paths import PODRACER_RUNDIR
+from podracer.poststop import GRAVEYARD_NAME, graveyard_backlog, reap
+from typing import List
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Remove ostree checkouts no container is using')
+  parser.add_argument('--keep', metavar='N', type=int, default=CHECKOUT_KEEP, help=f"unused checkouts to keep, most recently used first (default {CHECKOUT_KEEP})")
+  parser.add_argument('--grace', metavar='SECONDS', type=float, default=CHECKOUT_GRACE, help=f"never remove checkouts used this recently (default {CHECKOUT_GRACE})")
+  parser.add_argument('--dry-run', action='store_true', help='only print what would be removed')
+  parser.add_argument('--status', action='store_true', help='print the rundirs still waiting to be deleted as JSON, and exit')
+  args = parser.parse_args(argv)
+
+  graveyard = PODRACER_RUNDIR.joinpath(GRAVEYARD_NAME)
+  if args.status:
+    entries, size = graveyard_backlog(graveyard)
+    print(json.dumps({'graveyard': str(graveyard), 'entries': entries, 'bytes': size}))
+    return 0
+
+  # Normally the reaper started by each poststop hook empties this, but one
+  # could have been interrupted
+  if not args.dry_run:
+    reaped = reap(graveyard)
+    if reaped > 0:
+      sys.stderr.write(f"REAPED: {reaped} rundirs\n")
+
+  for sha in ostree_gc(args.keep, args.grace, args.dry_run):
+    if not args.dry_run:
+      sys.stderr.write(f"REMOVED: {sha}\n")
+    print(sha)
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
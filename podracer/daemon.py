@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from pathlib import Path
+from podracer.ostree import ostree_checkout_commit, ostree_rev_parse
+from podracer.overlay import podracer_overlay
+from podracer.paths import PODRACER_RUNDIR, PODRACER_SOCKET
+from podracer.poststop import poststop
+from typing import Dict, List, Optional, Tuple
+
+POOL_SIZE = 2
+MAX_HOT_REFS = 16
+REF_TTL = 5.0
+CLIENT_TIMEOUT = 30.0
+
+
+class Daemon:
+  # Keeps a few rundirs with overlays already mounted for each hot ref, so a
+  # container start only has to pick one up
+  def __init__(self, warm: List[str] = [], pool_size: int = POOL_SIZE, max_hot: int = MAX_HOT_REFS, ref_ttl: float = REF_TTL):
+    self.pool_size = pool_size
+    self.max_hot = max_hot
+    self.ref_ttl = ref_ttl
+    self.warm = list(warm)
+
+    self.lock = threading.Lock()
+    self.refs: Dict[str, Tuple[str, float]] = {}
+    self.pools: Dict[str, List[Path]] = {}
+    self.hot: OrderedDict = OrderedDict((ref, None) for ref in warm)
+    self.wakeup = threading.Event()
+    self.stopping = False
+
+
+  def resolve(self, ref: str, refresh: bool = False) -> str:
+    with self.lock:
+      if not refresh and ref in self.refs:
+        sha, resolved = self.refs[ref]
+        if time.monotonic() - resolved < self.ref_ttl:
+          return sha
+
+    sha = ostree_rev_parse(ref)
+    with self.lock:
+      self.refs[ref] = (sha, time.monotonic())
+    return sha
+
+
+  def prepare(self, sha: str) -> Path:
+    checkout = ostree_checkout_commit(sha)
+
+    PODRACER_RUNDIR.mkdir(mode=0o755, parents=True, exist_ok=True)
+    rundir = Path(tempfile.mkdtemp(dir=PODRACER_RUNDIR))
+    try:
+      podracer_overlay(rundir, checkout)
+    except:
+      poststop(rundir)
+      raise
+
+    return rundir
+
+
+  def acquire(self, ref: str) -> Tuple[str, Path]:
+    sha = self.resolve(ref)
+
+    with self.lock:
+      self.hot[ref] = None
+      self.hot.move_to_end(ref)
+      while len(self.hot) > self.max_hot + len(self.warm):
+        evicted = next(ref for ref in self.hot if ref not in self.warm)
+        del self.hot[evicted]
+
+      pool = self.pools.get(sha, [])
+      rundir = pool.pop() if len(pool) > 0 else None
+
+    self.wakeup.set()
+
+    if rundir is None:
+      rundir = self.prepare(sha)
+
+    # The container's poststop hook takes care of it from here
+    return sha, rundir
+
+
+  def release(self, sha: str, rundir: Path) -> None:
+    # Takes back a rundir the client never got, say because it gave up
+    # waiting for prepare(); it's as good as any other in the pool
+    with self.lock:
+      pool = self.pools.setdefault(sha, [])
+      if not self.stopping and len(pool) < self.pool_size:
+        pool.append(rundir)
+        return
+
+    poststop(rundir)
+
+
+  def refill(self) -> None:
+    with self.lock:
+      hot = list(self.hot)
+
+    wanted = set()
+    for ref in hot:
+      try:
+        sha = self.resolve(ref, refresh=True)
+      except Exception as error:
+        sys.stderr.write(f"WARNING: couldn't resolve {ref}: {error}\n")
+        continue
+
+      wanted.add(sha)
+      while not self.stopping:
+        with self.lock:
+          if len(self.pools.get(sha, [])) >= self.pool_size:
+            break
+
+        try:
+          rundir = self.prepare(sha)
+        except Exception as error:
+          sys.stderr.write(f"WARNING: couldn't prepare {ref}: {error}\n")
+          break
+
+        with self.lock:
+          self.pools.setdefault(sha, []).append(rundir)
+
+    # Tear down rundirs for commits no hot ref points at anymore
+    with self.lock:
+      stale = [sha for sha in self.pools if sha not in wanted]
+      rundirs = [rundir for sha in stale for rundir in self.pools.pop(sha)]
+
+    for rundir in rundirs:
+      poststop(rundir)
+
+
+  def run_refiller(self) -> None:
+    while not self.stopping:
+      self.refill()
+      self.wakeup.wait(self.ref_ttl / 2)
+      self.wakeup.clear()
+
+
+  def drain(self) -> None:
+    self.stopping = True
+    self.wakeup.set()
+
+    with self.lock:
+      rundirs = [rundir for pool in self.pools.values() for rundir in pool]
+      self.pools = {}
+
+    for rundir in rundirs:
+      poststop(rundir)
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+  def handle(self) -> None:
+    rundir = None
+    try:
+      request = json.loads(self.rfile.readline())
+      sha, rundir = self.server.daemon.acquire(request['ref'])
+      response = {'commit': sha, 'rundir': str(rundir)}
+    except Exception as error:
+      response = {'error': str(error)}
+
+    try:
+      self.wfile.write(json.dumps(response).encode() + b'\n')
+    except OSError as error:
+      sys.stderr.write(f"WARNING: couldn't reply to podracer-run: {error}\n")
+      if rundir is not None:
+        self.server.daemon.release(sha, rundir)
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path: Path, daemon: Daemon):
+    self.daemon = daemon
+    super().__init__(str(path), DaemonHandler)
+
+
+def daemon_acquire(ref: str, path: Path = PODRACER_SOCKET, timeout: float = CLIENT_TIMEOUT) -> Optional[Path]:
+  if not path.exists():
+    return None
+
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.settimeout(timeout)
+    client.connect(str(path))
+    client.sendall(json.dumps({'ref': ref}).encode() + b'\n')
+    with client.makefile('rb') as io:
+      response = json.loads(io.readline())
+
+  if 'error' in response:
+    raise RuntimeError(f"podracerd: {response['error']}")
+
+  return Path(response['rundir'])
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Keep overlays ready for podracer-run')
+  parser.add_argument('--warm', metavar='REF', action='append', default=[], help='always keep overlays ready for REF')
+  parser.add_argument('--pool-size', metavar='N', type=int, default=POOL_SIZE, help=f"overlays to keep ready per ref (default {POOL_SIZE})")
+  parser.add_argument('--max-hot', metavar='N', type=int, default=MAX_HOT_REFS, help=f"recently requested refs to keep overlays for (default {MAX_HOT_REFS})")
+  parser.add_argument('--ref-ttl', metavar='SECONDS', type=float, default=REF_TTL, help=f"how long to trust a resolved ref (default {REF_TTL})")
+  parser.add_argument('--socket', metavar='PATH', default=str(PODRACER_SOCKET), help=f"where to listen (default {PODRACER_SOCKET})")
+  args = parser.parse_args(argv)
+
+  path = Path(args.socket)
+  path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+  if path.exists():
+    path.unlink()
+
+  daemon = Daemon(args.warm, args.pool_size, args.max_hot, args.ref_ttl)
+  # Only root may ask for overlays, from the moment the socket exists
+  umask = os.umask(0o077)
+  try:
+    server = DaemonServer(path, daemon)
+  finally:
+    os.umask(umask)
+  os.chmod(path, 0o600)
+
+  stop = lambda signum, _: threading.Thread(target=server.shutdown).start()
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+
+  refiller = threading.Thread(target=daemon.run_refiller, daemon=True)
+  refiller.start()
+
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    path.unlink()
+    daemon.drain()
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,16 +1,27 @@
 import argparse
 import codecs
+import copy
+import errno
+import io
 import json
 import os
 import shutil
+import stat
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO, IOBase
 from pathlib import Path
-from typing import Dict, IO, Iterable, List, Set
+from typing import Dict, IO, Iterable, List, Optional, Tuple, Union
+
+
+BLOCK_SIZE = 1024 * 1024
+EXPORT_WORKERS = 8
+XATTR_PREFIX = 'SCHILY.xattr.'
 
 
 def find_export_command() -> str:
@@ -27,9 +38,6 @@ def find_export_command() -> str:
   return command
 
 
-EXPORT_COMMAND = find_export_command()
-
-
 class Archive:
   def __init__(self, buffer: IO[bytes]):
     self.buffer = buffer
@@ -41,47 +49,162 @@ class Archive:
     self.buffer.close()
 
 
-class Layer(Archive):
-  def __init__(self, archive: tarfile.TarFile, name: str):
-    buffer = archive.extractfile(name)
-    if buffer is None:
-      raise RuntimeError("No buffer for layer")
+class MaskNode:
+  __slots__ = ('children', 'flags')
 
-    super().__init__(buffer)
+  def __init__(self):
+    self.children: Dict[str, 'MaskNode'] = {}
+    self.flags = 0
+
+
+class Mask:
+  # Paths hidden from lower layers, stored as a prefix tree of path
+  # components so a lookup is one walk from the root
+  HIDE_SELF = 1
+  HIDE_CHILDREN = 2
+
+  def __init__(self):
+    self.root = MaskNode()
+
+
+  def node(self, path: str) -> MaskNode:
+    node = self.root
+    if len(path) > 0:
+      for part in path.split('/'):
+        child = node.children.get(part)
+        if child is None:
+          child = node.children[part] = MaskNode()
+        node = child
+    return node
+
+
+  def hide(self, path: str, flags: int = HIDE_SELF) -> None:
+    self.node(path).flags |= flags
+
+
+  def hide_all(self, paths: Iterable[str]) -> None:
+    for path in paths:
+      self.hide(path)
+
+
+  def update(self, other: 'Mask') -> None:
+    pending = [(self.root, other.root)]
+    while len(pending) > 0:
+      node, other_node = pending.pop()
+      node.flags |= other_node.flags
+      for part, other_child in other_node.children.items():
+        child = node.children.get(part)
+        if child is None:
+          child = node.children[part] = MaskNode()
+        pending.append((child, other_child))
+
+
+  def is_masked(self, path: str) -> bool:
+    node = self.root
+    for part in path.split('/'):
+      if node.flags & Mask.HIDE_CHILDREN:
+        return True
+      node = node.children.get(part)
+      if node is None:
+        return False
+    return (node.flags & Mask.HIDE_SELF) != 0
+
+
+  def is_opaque(self) -> bool:
+    return (self.root.flags & Mask.HIDE_CHILDREN) != 0
+
+
+def real_fileno(buffer: IO[bytes]) -> Optional[int]:
+  try:
+    return buffer.fileno()
+  except (AttributeError, OSError, io.UnsupportedOperation):
+    return None
 
+
+class LayerIndex:
+  # The files a layer adds and the paths its whiteouts hide, which is all
+  # merge_layers needs to know about it
+  def __init__(self, name: str):
     self.name = name
     self.files = set()
-    self.mask = set()
+    self.mask = Mask()
+
+
+  def add_path(self, path: str) -> None:
+    parent, _, basename = path.rpartition('/')
+    if not basename.startswith('.wh.'):
+      self.files.add(path)
+      return
+
+    if basename == '.wh..wh..opq':
+      # Discard everything in the same directory
+      self.mask.hide(parent, Mask.HIDE_CHILDREN)
+    else:
+      # Discard one file, or a directory and everything in it
+      if len(parent) > 0:
+        parent += '/'
+      self.mask.hide(parent + basename[4:], Mask.HIDE_SELF | Mask.HIDE_CHILDREN)
+
+
+class LayerListing(LayerIndex):
+  # A layer known only by its list of paths, e.g. one already in ostree
+  def __init__(self, name: str, paths: Iterable[str]):
+    super().__init__(name)
+    self.paths = list(paths)
+    for path in self.paths:
+      self.add_path(path)
+
+
+class Layer(Archive, LayerIndex):
+  def __init__(self, buffer: IO[bytes], name: str, base: Tuple[IO[bytes], int] = None):
+    Archive.__init__(self, buffer)
+    LayerIndex.__init__(self, name)
+
+    # Where the layer starts in an OS-level file, if it's in one, so member
+    # bodies can be copied by the kernel; see locate(). Member offsets are
+    # only file offsets when tarfile reads the buffer as is, uncompressed
+    if self.archive.fileobj is not buffer:
+      base = None
+    elif base is None and real_fileno(buffer) is not None:
+      base = (buffer, 0)
+    self.base = base
+    self.members: Dict[str, tarfile.TarInfo] = {}
 
     for member in self.archive.getmembers():
-      path = Path(member.name)
-      if not path.name.startswith('.wh.'):
-        self.files.add(member.name)
-        continue
+      self.members[member.name] = member
+      self.add_path(member.name)
 
-      if len(path.parent.name) > 0:
-        prefix = str(path.parent) + '/'
-      else:
-        prefix = ''
 
-      if path.name == '.wh..wh..opq':
-        # Discard everything in the same directory
-        self.mask.add(prefix)
-      else:
-        # Just discard one file
-        self.mask.add(prefix + path.name[4:])
+  @property
+  def paths(self) -> Iterable[str]:
+    return self.members.keys()
+
+
+  def locate(self, member: tarfile.TarInfo) -> Optional[Tuple[int, int]]:
+    # The file descriptor and offset of a member's body, if it's stored
+    # contiguously in a real file
+    if self.base is None or member.issparse():
+      return None
+
+    fileobj, offset = self.base
+    return fileobj.fileno(), offset + member.offset_data
 
 
 class Image(Archive):
-  def __init__(self, name: str):
-    buffer = tempfile.TemporaryFile()
-    try:
-      subprocess.run([EXPORT_COMMAND, 'save', name], check=True, stdout=buffer, stderr=subprocess.PIPE)
-    except:
-      buffer.close()
-      raise
+  def __init__(self, name: str = None, archive: str = None):
+    # Reads a docker-archive saved earlier, if given, instead of saving name
+    if archive is not None:
+      buffer = open(archive, 'rb')
+    else:
+      buffer = tempfile.TemporaryFile()
+      try:
+        subprocess.run([find_export_command(), 'save', name], check=True, stdout=buffer, stderr=subprocess.PIPE)
+      except:
+        buffer.close()
+        raise
+
+      buffer.seek(0)
 
-    buffer.seek(0)
     super().__init__(buffer)
 
     manifest_buffer = self.archive.extractfile("manifest.json")
@@ -92,21 +215,20 @@ class Image(Archive):
     if len(manifest) != 1:
       raise RuntimeError(f"Expected exactly 1 image in manifest, got {len(manifest)}")
 
-    self.layers = list(map(lambda name: Layer(self.archive, name), manifest[0]["Layers"]))
+    self.layers = list(map(self.open_layer, manifest[0]["Layers"]))
 
 
-def parent_paths(filename: str) -> Iterable[str]:
-  path = Path(filename)
-  while len(path.parent.name) > 0:
-    yield str(path.parent) + '/'
-    path = path.parent
+  def open_layer(self, name: str) -> Layer:
+    member = self.archive.getmember(name)
+    buffer = self.archive.extractfile(member)
+    if buffer is None:
+      raise RuntimeError("No buffer for layer")
 
+    base = None
+    if not member.issparse() and self.archive.fileobj is self.buffer and real_fileno(self.buffer) is not None:
+      base = (self.buffer, member.offset_data)
 
-def is_parent_masked(filename: str, mask: Set[str]) -> bool:
-  for parent in parent_paths(filename):
-    if parent in mask:
-      return True
-  return False
+    return Layer(buffer, name, base)
 
 
 def make_buffer(content: str) -> BytesIO:
@@ -116,61 +238,353 @@ def make_buffer(content: str) -> BytesIO:
   return buffer
 
 
-def export_rootfs(image_name: str, output: IO[bytes], inject: Dict[str, str] = {}) -> None:
-  image = Image(image_name)
-  mask: Set[str] = set()
-  files: Dict[str, Layer] = {}
+class StreamWriter:
+  # Writes a tar stream straight to a file descriptor, like tarfile's 'w|'
+  # mode, but has the kernel copy file bodies that are in real files
+  def __init__(self, fd: int):
+    self.fd = fd
+    self.offset = 0
+    self.copy_file_range = hasattr(os, 'copy_file_range')
+    self.sendfile = hasattr(os, 'sendfile')
+
+
+  def write(self, data: bytes) -> None:
+    view = memoryview(data)
+    while len(view) > 0:
+      written = os.write(self.fd, view)
+      view = view[written:]
+    self.offset += len(data)
+
+
+  def copy(self, source: Tuple[int, int], size: int) -> None:
+    fd, offset = source
+    end = offset + size
+
+    while offset < end:
+      if not self.copy_file_range and not self.sendfile:
+        data = os.pread(fd, min(end - offset, BLOCK_SIZE), offset)
+        if len(data) < 1:
+          raise RuntimeError("Layer ended in the middle of a file")
+        self.write(data)
+        offset += len(data)
+        continue
+
+      try:
+        if self.copy_file_range:
+          copied = os.copy_file_range(fd, self.fd, end - offset, offset)
+        else:
+          copied = os.sendfile(self.fd, fd, offset, end - offset)
+      except OSError as error:
+        # Not every pair of files supports every kind of copy; pipes only
+        # take sendfile, for instance
+        if error.errno not in (errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+          raise
+        if self.copy_file_range:
+          self.copy_file_range = False
+        else:
+          self.sendfile = False
+        continue
+
+      if copied < 1:
+        raise RuntimeError("Layer ended in the middle of a file")
+      offset += copied
+      self.offset += copied
+
+
+  def addfile(self, member: tarfile.TarInfo, fileobj: IO[bytes] = None, source: Tuple[int, int] = None) -> None:
+    member = copy.copy(member)
+    self.write(member.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+
+    if member.size > 0:
+      if source is not None:
+        self.copy(source, member.size)
+      else:
+        remaining = member.size
+        while remaining > 0:
+          data = fileobj.read(min(remaining, BLOCK_SIZE))
+          if len(data) < 1:
+            raise RuntimeError("Layer ended in the middle of a file")
+          self.write(data)
+          remaining -= len(data)
+
+      self.pad(tarfile.BLOCKSIZE)
+
+
+  def pad(self, size: int) -> None:
+    remainder = self.offset % size
+    if remainder > 0:
+      self.write(tarfile.NUL * (size - remainder))
+
+
+  def close(self) -> None:
+    self.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+    self.pad(tarfile.RECORDSIZE)
+
+
+def merge_layers(layers: List[LayerIndex]) -> Dict[str, LayerIndex]:
+  # Which layer each file in the merged rootfs comes from
+  mask = Mask()
+  files: Dict[str, LayerIndex] = {}
 
   # Build the list of files
-  for layer in reversed(image.layers):
+  for layer in reversed(layers):
     for filename in layer.files:
-      if filename in mask:
+      if mask.is_masked(filename):
         continue
 
       assert filename not in files, f"{filename} from {layer.name} conflicts with {files[filename].name}"
 
-      if is_parent_masked(filename, mask):
-        continue
-
       # Take this file from this layer
       files[filename] = layer
 
     # Grow the mask
     mask.update(layer.mask)
-    mask.update(layer.files)
+    mask.hide_all(layer.files)
 
     # '.wh..wh..opq' in root, skip all remaining layers
-    if '' in mask:
+    if mask.is_opaque():
       break
 
-  # Write the exported rootfs
-  with tarfile.open(mode='w', fileobj=output) as tarball:
-    for filename in sorted(list(files.keys()) + list(inject.keys())):
-      if filename in inject:
-        # Synthesize the file
-        buffer = make_buffer(inject[filename])
-        member = tarfile.TarInfo(filename)
-        member.size = len(buffer.getvalue())
-        tarball.addfile(member, buffer)
+  return files
+
+
+def export_layers(layers: List[Layer], output: IO[bytes], inject: Dict[str, str] = {}) -> None:
+  files = merge_layers(layers)
+
+  # Write the exported rootfs, straight to the file descriptor if there is one
+  fd = real_fileno(output)
+  if fd is not None:
+    output.flush()
+    tarball = StreamWriter(fd)
+  else:
+    tarball = tarfile.open(mode='w|', fileobj=output)
+
+  for filename in sorted(list(files.keys()) + list(inject.keys())):
+    if filename in inject:
+      # Synthesize the file
+      buffer = make_buffer(inject[filename])
+      member = tarfile.TarInfo(filename)
+      member.size = len(buffer.getvalue())
+      tarball.addfile(member, buffer)
+    else:
+      # Copy the file from its layer
+      layer = files[filename]
+      member = layer.members[filename]
+      if member.size < 1:
+        tarball.addfile(member)
+      elif fd is not None and layer.locate(member) is not None:
+        tarball.addfile(member, source=layer.locate(member))
       else:
-        # Copy the file from its layer
-        layer = files[filename]
-        member = layer.archive.getmember(filename)
-        if member.size > 0:
-          tarball.addfile(member, layer.archive.extractfile(filename))
-        else:
-          tarball.addfile(member)
+        tarball.addfile(member, layer.archive.extractfile(member))
+
+  tarball.close()
+  output.close()
+
+
+def safe_path(root: Path, name: str) -> Path:
+  parts = [part for part in name.split('/') if part not in ('', '.')]
+  if '..' in parts:
+    raise RuntimeError(f"Refusing to export {name} outside of the rootfs")
+  return root.joinpath(*parts)
+
+
+def apply_metadata(path: Path, member: tarfile.TarInfo, owner: bool) -> None:
+  # Ownership first, because chown clears setuid and setgid bits
+  if owner:
+    os.lchown(path, member.uid, member.gid)
+  if not member.issym():
+    os.chmod(path, member.mode)
+
+  for key, value in member.pax_headers.items():
+    if key.startswith(XATTR_PREFIX):
+      try:
+        os.setxattr(path, key[len(XATTR_PREFIX):], value.encode('utf-8', 'surrogateescape'), follow_symlinks=False)
+      except OSError as error:
+        # Only root can set most namespaces, and not every filesystem can
+        # store them at all
+        if error.errno not in (errno.EPERM, errno.ENOTSUP):
+          raise
+
+  os.utime(path, (member.mtime, member.mtime), follow_symlinks=False)
 
-    tarball.close()
-    output.close()
+
+def unchanged(path: Path, member: tarfile.TarInfo, owner: bool) -> bool:
+  # The same quick check as rsync: size, modification time and mode
+  try:
+    info = os.lstat(path)
+  except FileNotFoundError:
+    return False
+
+  if not stat.S_ISREG(info.st_mode) or info.st_size != member.size or int(info.st_mtime) != int(member.mtime):
+    return False
+  if stat.S_IMODE(info.st_mode) != member.mode:
+    return False
+  return not owner or (info.st_uid, info.st_gid) == (member.uid, member.gid)
+
+
+class DirectoryWriter:
+  # Writes a merged rootfs straight into a directory, several directories'
+  # worth of files at a time
+  def __init__(self, files: Dict[str, Layer], destination: Path, previous: Path = None):
+    self.files = files
+    self.destination = destination
+    self.previous = previous
+    self.owner = os.geteuid() == 0
+
+    # tarfile can't read from two threads at once, for layers that have to
+    # go through it
+    self.locks = {id(layer): threading.Lock() for layer in files.values()}
+
+
+  def write_body(self, layer: Layer, member: tarfile.TarInfo, path: Path) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    try:
+      source = layer.locate(member)
+      if member.size < 1:
+        pass
+      elif source is not None:
+        StreamWriter(fd).copy(source, member.size)
+      else:
+        with self.locks[id(layer)], os.fdopen(os.dup(fd), 'wb') as output:
+          shutil.copyfileobj(layer.archive.extractfile(member), output, BLOCK_SIZE)
+    finally:
+      os.close(fd)
+
+
+  def write_member(self, layer: Layer, member: tarfile.TarInfo, path: Path) -> None:
+    if member.isreg():
+      if self.previous is not None:
+        previous = safe_path(self.previous, member.name)
+        if unchanged(previous, member, self.owner):
+          try:
+            # Shares the inode, metadata and all
+            os.link(previous, path)
+            return
+          except OSError as error:
+            if error.errno != errno.EXDEV:
+              raise
+      self.write_body(layer, member, path)
+    elif member.issym():
+      os.symlink(member.linkname, path)
+    elif member.isfifo():
+      os.mkfifo(path, 0o600)
+    elif member.ischr() or member.isblk():
+      kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+      try:
+        os.mknod(path, kind | 0o600, os.makedev(member.devmajor, member.devminor))
+      except PermissionError:
+        # Like tar, only root gets device nodes
+        return
+    else:
+      raise RuntimeError(f"Don't know how to export {member.name} from {layer.name}")
+
+    apply_metadata(path, member, self.owner)
+
+
+  def write_group(self, filenames: List[str]) -> None:
+    for filename in filenames:
+      layer = self.files[filename]
+      self.write_member(layer, layer.members[filename], safe_path(self.destination, filename))
+
+
+  def write_link(self, filename: str) -> None:
+    layer = self.files[filename]
+    member = layer.members[filename]
+    path = safe_path(self.destination, filename)
+
+    if self.files.get(member.linkname) is layer:
+      os.link(safe_path(self.destination, member.linkname), path, follow_symlinks=False)
+      return
+
+    # The file it links to was replaced or hidden by a later layer, so it
+    # gets its own copy of the original
+    target = layer.members.get(member.linkname)
+    if target is None or not target.isreg():
+      raise RuntimeError(f"{filename} in {layer.name} links to {member.linkname}, which isn't a file in the same layer")
+
+    self.write_body(layer, target, path)
+    apply_metadata(path, member, self.owner)
+
+
+  def write(self, inject: Dict[str, str] = {}, workers: int = EXPORT_WORKERS) -> None:
+    directories = []
+    groups: Dict[str, List[str]] = {}
+    links = []
+
+    for filename in sorted(self.files):
+      member = self.files[filename].members[filename]
+      if member.isdir():
+        directories.append(filename)
+      elif member.islnk():
+        links.append(filename)
+      else:
+        groups.setdefault(filename.rpartition('/')[0], []).append(filename)
+
+    # Every directory exists before anything else is written, so nothing
+    # can be written through a symlink from the image
+    for filename in directories:
+      safe_path(self.destination, filename).mkdir(mode=0o700, parents=True, exist_ok=True)
+    for parent in groups:
+      safe_path(self.destination, parent).mkdir(mode=0o755, parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      for _ in executor.map(self.write_group, groups.values()):
+        pass
+
+    for filename in links:
+      self.write_link(filename)
+
+    for filename, content in inject.items():
+      path = safe_path(self.destination, filename)
+      path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+      path.write_text(content)
+
+    # Last, and deepest first, since adding files changes a directory's
+    # modification time, and its mode may not let us add them at all
+    for filename in reversed(directories):
+      layer = self.files[filename]
+      apply_metadata(safe_path(self.destination, filename), layer.members[filename], self.owner)
+
+
+def export_directory(layers: List[Layer], destination: Union[str, Path], inject: Dict[str, str] = {}, previous: Union[str, Path] = None, workers: int = EXPORT_WORKERS) -> None:
+  destination = Path(destination)
+  destination.mkdir(mode=0o755, parents=True, exist_ok=True)
+  if any(destination.iterdir()):
+    raise RuntimeError(f"{destination} is not empty")
+
+  writer = DirectoryWriter(merge_layers(layers), destination, Path(previous) if previous is not None else None)
+  writer.write(inject, workers)
+
+
+def export_rootfs(image_name: str, output: Union[IO[bytes], str, Path], inject: Dict[str, str] = {}, archive: str = None, previous: Union[str, Path] = None) -> None:
+  # A path means a directory to export into, rather than a tarball
+  image = Image(image_name, archive)
+  if isinstance(output, (str, os.PathLike)):
+    export_directory(image.layers, output, inject, previous)
+  else:
+    export_layers(image.layers, output, inject)
 
 
 def main(argv: List[str] = sys.argv[1:]) -> int:
   parser = argparse.ArgumentParser(description='Export container rootfs as tarball')
-  parser.add_argument('image', metavar='IMAGE', help='image to export')
+  parser.add_argument('image', metavar='IMAGE', nargs='?', help='image to export')
+  parser.add_argument('-i', '--input', metavar='PATH', help='export from a docker-archive saved earlier, instead of IMAGE')
   parser.add_argument('-o', '--output', metavar='PATH', help='where to write output; defaults to stdout')
+  parser.add_argument('--output-dir', metavar='PATH', help='write the rootfs into an empty directory instead of a tarball')
+  parser.add_argument('--previous', metavar='PATH', help='with --output-dir, hardlink files unchanged since an earlier export into PATH')
   args = parser.parse_args(argv)
 
+  if (args.image is None) == (args.input is None):
+    parser.error('exactly one of IMAGE and --input is required')
+
+  if args.output_dir is not None:
+    if args.output is not None:
+      parser.error('--output and --output-dir cannot be used together')
+    export_rootfs(args.image, args.output_dir, archive=args.input, previous=args.previous)
+    return 0
+  elif args.previous is not None:
+    parser.error('--previous needs --output-dir')
+
   if args.output is None:
     if sys.stdout.isatty():
       raise RuntimeError("Cowardly refusing to write an archive to a terminal; try using -o or redirecting the output")
@@ -178,7 +592,7 @@ def main(argv: List[str] = sys.argv[1:]) -> int:
   else:
     output = open(args.output, 'wb')
 
-  export_rootfs(args.image, output)
+  export_rootfs(args.image, output, archive=args.input)
   return 0
 
 
@@ -0,0 +1,172 @@
+import struct
+
+from typing import Any, List, Optional
+
+# Just enough of the GVariant serialization format to read ostree's commit
+# objects without going through the ostree CLI; see
+# https://people.gnome.org/~desrt/gvariant-serialisation.pdf
+
+FIXED_TYPES = {
+  'y': (1, 'B'), 'b': (1, '?'),
+  'n': (2, 'h'), 'q': (2, 'H'),
+  'i': (4, 'i'), 'u': (4, 'I'), 'h': (4, 'i'),
+  'x': (8, 'q'), 't': (8, 'Q'), 'd': (8, 'd'),
+}
+
+
+def type_end(signature: str, start: int) -> int:
+  char = signature[start]
+  if char in 'am':
+    return type_end(signature, start + 1)
+  if char in '({':
+    close = ')' if char == '(' else '}'
+    index = start + 1
+    while signature[index] != close:
+      index = type_end(signature, index)
+    return index + 1
+  return start + 1
+
+
+def split_types(signature: str) -> List[str]:
+  types = []
+  index = 0
+  while index < len(signature):
+    end = type_end(signature, index)
+    types.append(signature[index:end])
+    index = end
+  return types
+
+
+def align(offset: int, alignment: int) -> int:
+  return (offset + alignment - 1) & ~(alignment - 1)
+
+
+def alignment(signature: str) -> int:
+  if signature in FIXED_TYPES:
+    return FIXED_TYPES[signature][0]
+  if signature == 'v':
+    return 8
+  if signature[0] in 'am':
+    return alignment(signature[1:])
+  if signature[0] in '({':
+    return max([alignment(member) for member in split_types(signature[1:-1])] + [1])
+  return 1
+
+
+def fixed_size(signature: str) -> Optional[int]:
+  if signature in FIXED_TYPES:
+    return FIXED_TYPES[signature][0]
+  if signature[0] not in '({':
+    return None
+
+  members = split_types(signature[1:-1])
+  if len(members) < 1:
+    return 1
+
+  size = 0
+  for member in members:
+    member_size = fixed_size(member)
+    if member_size is None:
+      return None
+    size = align(size, alignment(member)) + member_size
+  return align(size, alignment(signature))
+
+
+def offset_size(size: int) -> int:
+  if size > 0xffffffff:
+    return 8
+  if size > 0xffff:
+    return 4
+  if size > 0xff:
+    return 2
+  if size > 0:
+    return 1
+  return 0
+
+
+def read_offset(data: bytes, position: int, size: int) -> int:
+  return int.from_bytes(data[position:position + size], 'little')
+
+
+def decode_array(element: str, data: bytes) -> List[Any]:
+  if len(data) < 1:
+    return []
+
+  size = fixed_size(element)
+  if size is not None:
+    return [decode(element, data[index:index + size]) for index in range(0, len(data), size)]
+
+  osize = offset_size(len(data))
+  table = read_offset(data, len(data) - osize, osize)
+  elements = []
+  start = 0
+  for position in range(table, len(data), osize):
+    end = read_offset(data, position, osize)
+    elements.append(decode(element, data[align(start, alignment(element)):end]))
+    start = end
+  return elements
+
+
+def decode_tuple(members: List[str], data: bytes) -> List[Any]:
+  osize = offset_size(len(data))
+  frame = len(data)
+  values = []
+  start = 0
+
+  for index, member in enumerate(members):
+    start = align(start, alignment(member))
+    size = fixed_size(member)
+    if size is not None:
+      end = start + size
+    elif index == len(members) - 1:
+      end = frame
+    else:
+      # Framing offsets are stored backwards from the end of the container
+      frame -= osize
+      end = read_offset(data, frame, osize)
+
+    values.append(decode(member, data[start:end]))
+    start = end
+
+  return values
+
+
+def decode(signature: str, data: bytes) -> Any:
+  if signature in FIXED_TYPES:
+    return struct.unpack('<' + FIXED_TYPES[signature][1], data)[0]
+  if signature in ('s', 'o', 'g'):
+    return data[:-1].decode()
+  if signature == 'ay':
+    return bytes(data)
+  if signature == 'v':
+    separator = data.rindex(b'\0')
+    return decode(data[separator + 1:].decode(), data[:separator])
+  if signature[0] == 'a':
+    elements = decode_array(signature[1:], data)
+    if signature[1] == '{':
+      return dict(elements)
+    return elements
+  if signature[0] == 'm':
+    if len(data) < 1:
+      return None
+    if fixed_size(signature[1:]) is None:
+      data = data[:-1]
+    return decode(signature[1:], data)
+  if signature[0] in '({':
+    return decode_tuple(split_types(signature[1:-1]), data)
+  raise ValueError(f"Unsupported GVariant type: {signature}")
+
+
+def decode_commit(data: bytes) -> dict:
+  metadata, parent, _, subject, body, timestamp, root_contents, root_metadata = decode('(a{sv}aya(say)sstayay)', data)
+
+  return {
+    'metadata': metadata,
+    'parent': parent.hex() if len(parent) > 0 else None,
+    'subject': subject,
+    'body': body,
+    # ostree stores this one big-endian, unlike everything else
+    'timestamp': int.from_bytes(timestamp.to_bytes(8, 'little'), 'big'),
+    'root_contents': root_contents.hex(),
+    'root_metadata': root_metadata.hex(),
+  }
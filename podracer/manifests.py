@@ -1,9 +1,10 @@
 import argparse
+import asyncio
 import json
 import sys
 from typing import Iterable, List
 
-from podracer.registry import get_manifests
+from podracer.registry import MANIFEST_JOBS, AsyncRegistryClient, get_manifests
 
 
 def filter_manifests(manifests: List[dict], arch: str = None, osname: str = None, variant: str = None) -> Iterable[dict]:
@@ -25,16 +26,46 @@ def filter_manifests(manifests: List[dict], arch: str = None, osname: str = None
     yield manifest
 
 
+async def inspect_images(images: List[str], args: argparse.Namespace) -> int:
+  # One JSON line per image, printed as soon as its manifests arrive
+  status = 0
+  async with AsyncRegistryClient(jobs=args.jobs) as client:
+    async for image, manifests, error in client.inspect(images):
+      if error is not None:
+        print(json.dumps({'image': image, 'error': str(error) or type(error).__name__}), flush=True)
+        status = 1
+        continue
+
+      manifests = list(filter_manifests(manifests, args.arch, args.os, args.variant))
+      if len(manifests) < 1:
+        status = 1
+      print(json.dumps({'image': image, 'manifests': manifests}), flush=True)
+
+  return status
+
+
 def main(argv: List[str] = sys.argv[1:]) -> int:
   parser = argparse.ArgumentParser(description='Inspect registry manifests')
-  parser.add_argument('image', metavar='IMAGE', help='image to inspect')
+  parser.add_argument('images', metavar='IMAGE', nargs='*', help='images to inspect; read one per line from stdin if none are given')
   parser.add_argument('--arch', metavar='ARCH', help='filter by architecture')
   parser.add_argument('--os', metavar='OS', help='filter by OS')
   parser.add_argument('--variant', metavar='VARIANT', help='filter by variant')
-  parser.add_argument('--output', metavar='yaml|json|digests', help='output format; "digests" prints one digest per line')
+  parser.add_argument('--output', metavar='yaml|json|digests|jsonl', help='output format; "digests" prints one digest per line, "jsonl" one line per image (the default for more than one image)')
+  parser.add_argument('--jobs', metavar='N', type=int, default=MANIFEST_JOBS, help=f"images to inspect at once (default {MANIFEST_JOBS})")
   args = parser.parse_args(argv)
 
-  manifests = list(filter_manifests(get_manifests(args.image), args.arch, args.os, args.variant))
+  images = args.images
+  if len(images) < 1:
+    images = [line.strip() for line in sys.stdin if len(line.strip()) > 0 and not line.startswith('#')]
+    if len(images) < 1:
+      parser.error('no IMAGE given, as an argument or on stdin')
+
+  if len(args.images) != 1 or args.output == 'jsonl':
+    if args.output not in [None, 'jsonl']:
+      parser.error(f"--output {args.output} only works with a single image")
+    return asyncio.run(inspect_images(images, args))
+
+  manifests = list(filter_manifests(get_manifests(images[0]), args.arch, args.os, args.variant))
 
   if len(manifests) < 1:
     sys.stderr.write("No manifests found\n")
@@ -1,22 +1,286 @@
+import base64
+import configparser
+import fcntl
+import os
+import shutil
 import subprocess
+import time
 
+from contextlib import contextmanager
 from pathlib import Path
-from podracer.paths import PODRACER_LIBDIR
+from podracer.gvariant import decode_commit
+from podracer.paths import PODRACER_LIBDIR, PODRACER_MIRROR
 from podracer.capture import capture_output
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+OSTREE_DEFAULT_REPO = '/ostree/repo'
+METADATA_PREFIX = 'com.getseam.podracer.'
+
+CHECKOUT_ROOT = PODRACER_LIBDIR.joinpath('ostree')
+CHECKOUT_KEEP = int(os.environ.get('PODRACER_CHECKOUT_KEEP', '2'))
+CHECKOUT_GRACE = 600
+MIRROR_REF_PREFIX = 'podracer/checkouts/'
 
 
 def ostree_rev_parse(ref: str) -> str:
   return capture_output('ostree', 'rev-parse', ref, suppress_stderr=True)
 
 
+@contextmanager
+def checkout_lock(name: str, blocking: bool = True) -> Iterator[bool]:
+  fd = os.open(CHECKOUT_ROOT.joinpath(f".{name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+  try:
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+      yield False
+      return
+    yield True
+  finally:
+    os.close(fd)
+
+
+def ostree_repo_mode(repo: Path) -> Optional[str]:
+  config = configparser.ConfigParser()
+  if len(config.read(repo.joinpath('config'))) < 1:
+    return None
+  return config.get('core', 'mode', fallback='bare')
+
+
+def ostree_mirror(sha: str, mirror: Path) -> None:
+  # Only root can write the ownership of container files into a bare repo;
+  # anyone else gets everything owned by themselves
+  # Also keeps ostree_gc from pruning the mirror while we're pulling into it
+  with checkout_lock('mirror'):
+    if ostree_repo_mode(mirror) is None:
+      mode = 'bare' if os.geteuid() == 0 else 'bare-user-only'
+      subprocess.run(['ostree', f"--repo={mirror}", 'init', f"--mode={mode}"], check=True)
+
+    subprocess.run(['ostree', f"--repo={mirror}", 'pull-local', str(ostree_repo_path()), sha], check=True)
+
+    # Keeps the commit from being pruned until its checkout is collected
+    if not mirror.joinpath('refs', 'heads', MIRROR_REF_PREFIX + sha).exists():
+      subprocess.run(['ostree', f"--repo={mirror}", 'refs', f"--create={MIRROR_REF_PREFIX}{sha}", sha], check=True)
+
+
+def checkout_argv(sha: str, destination: Path) -> List[str]:
+  if PODRACER_MIRROR is None:
+    return ['ostree', 'checkout', sha, str(destination)]
+
+  # Hardlink the checkout from the local mirror, so it costs next to nothing
+  # and identical files share inodes across images
+  ostree_mirror(sha, PODRACER_MIRROR)
+
+  argv = ['ostree', f"--repo={PODRACER_MIRROR}", 'checkout', '--require-hardlinks']
+  if ostree_repo_mode(PODRACER_MIRROR) != 'bare':
+    argv.append('--user-mode')
+  return argv + [sha, str(destination)]
+
+
 def ostree_checkout(ref: str) -> Path:
-  sha = ostree_rev_parse(ref)
+  return ostree_checkout_commit(ostree_rev_parse(ref))
+
 
-  checkout_root = PODRACER_LIBDIR.joinpath('ostree')
-  checkout_root.mkdir(mode=0o755, parents=True, exist_ok=True)
+def ostree_checkout_commit(sha: str) -> Path:
+  CHECKOUT_ROOT.mkdir(mode=0o755, parents=True, exist_ok=True)
+  checkout = CHECKOUT_ROOT.joinpath(sha)
 
-  checkout = checkout_root.joinpath(sha)
-  if not checkout.is_dir():
-    subprocess.run(['ostree', 'checkout', sha, str(checkout)], check=True)
+  # Concurrent runs of the same commit wait here for one shared checkout
+  with checkout_lock(sha):
+    if not checkout.is_dir():
+      staging = CHECKOUT_ROOT.joinpath(f".{sha}.{os.getpid()}")
+      try:
+        subprocess.run(checkout_argv(sha, staging), check=True)
+        os.rename(staging, checkout)
+      except:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    # Marks the checkout as recently used, so ostree_gc leaves it alone
+    os.utime(checkout)
 
   return checkout
+
+
+def mounted_lowerdirs() -> Set[str]:
+  lowerdirs = set()
+
+  with open('/proc/self/mountinfo') as io:
+    for line in io:
+      fstype, _, options = line.split(' - ', 1)[1].split(' ', 2)
+      if fstype != 'overlay':
+        continue
+
+      for option in options.strip().split(','):
+        if option.startswith('lowerdir='):
+          lowerdirs.update(option[9:].split(':'))
+
+  return lowerdirs
+
+
+def ostree_gc(keep: int = CHECKOUT_KEEP, grace: float = CHECKOUT_GRACE, dry_run: bool = False) -> List[str]:
+  if not CHECKOUT_ROOT.is_dir():
+    return []
+
+  # Leftovers from a collection that was interrupted
+  for entry in os.scandir(CHECKOUT_ROOT):
+    if entry.name.startswith('.trash.') and not dry_run:
+      shutil.rmtree(entry.path, ignore_errors=True)
+
+  in_use = mounted_lowerdirs()
+  checkouts = []
+  for entry in os.scandir(CHECKOUT_ROOT):
+    if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+      checkouts.append((entry.stat().st_mtime, entry.name))
+
+  unused = [(mtime, sha) for mtime, sha in checkouts if str(CHECKOUT_ROOT.joinpath(sha)) not in in_use]
+  unused.sort(reverse=True)
+
+  removed = []
+  for mtime, sha in unused[keep:]:
+    checkout = CHECKOUT_ROOT.joinpath(sha)
+    trash = CHECKOUT_ROOT.joinpath(f".trash.{sha}")
+
+    with checkout_lock(sha, blocking=False) as locked:
+      # Someone is checking this out right now, or has just done so and
+      # hasn't mounted it yet
+      if not locked or time.time() - checkout.stat().st_mtime < grace:
+        continue
+      if dry_run:
+        removed.append(sha)
+        continue
+      os.rename(checkout, trash)
+
+    shutil.rmtree(trash)
+    removed.append(sha)
+
+    if PODRACER_MIRROR is not None:
+      subprocess.run(['ostree', f"--repo={PODRACER_MIRROR}", 'refs', '--delete', MIRROR_REF_PREFIX + sha], stderr=subprocess.DEVNULL)
+
+  if len(removed) > 0 and PODRACER_MIRROR is not None and not dry_run:
+    with checkout_lock('mirror'):
+      subprocess.run(['ostree', f"--repo={PODRACER_MIRROR}", 'prune', '--refs-only'], stdout=subprocess.DEVNULL, check=True)
+
+  return removed
+
+
+def ostree_repo_path(repo: str = None) -> Path:
+  if repo is not None:
+    return Path(repo)
+  return Path(os.environ.get('OSTREE_REPO', OSTREE_DEFAULT_REPO))
+
+
+def read_refs(root: Path, prefix: str = '') -> Dict[str, str]:
+  refs = {}
+  for dirpath, _, filenames in os.walk(root):
+    for filename in filenames:
+      path = Path(dirpath, filename)
+      with open(path) as io:
+        refs[prefix + str(path.relative_to(root))] = io.read().strip()
+  return refs
+
+
+def ostree_refs(repo: str = None) -> Dict[str, str]:
+  refs_dir = ostree_repo_path(repo).joinpath('refs')
+  refs = read_refs(refs_dir.joinpath('heads'))
+
+  remotes = refs_dir.joinpath('remotes')
+  if remotes.is_dir():
+    for remote in remotes.iterdir():
+      refs.update(read_refs(remote, f"{remote.name}:"))
+
+  return refs
+
+
+def ostree_read_commit(sha: str, repo: str = None) -> dict:
+  path = ostree_repo_path(repo).joinpath('objects', sha[:2], f"{sha[2:]}.commit")
+  with open(path, 'rb') as io:
+    return decode_commit(io.read())
+
+
+def ostree_history(sha: str, depth: int = None, repo: str = None) -> List[Tuple[str, dict]]:
+  # A commit and up to depth of its parents, nearest first, as far as the
+  # repo has them
+  history = []
+  while depth is None or len(history) < depth + 1:
+    try:
+      commit = ostree_read_commit(sha, repo)
+    except FileNotFoundError:
+      # Pruned, or never pulled
+      break
+    history.append((sha, commit))
+    if commit['parent'] is None:
+      break
+    sha = commit['parent']
+
+  return history
+
+
+def ostree_ancestors(sha: str, depth: int, repo: str = None) -> List[str]:
+  return [parent for parent, _ in ostree_history(sha, depth, repo)[1:]]
+
+
+def delta_name(sha: str) -> str:
+  # ostree names deltas with unpadded base64 checksums, using _ for /
+  return base64.b64encode(bytes.fromhex(sha)).decode().rstrip('=').replace('/', '_')
+
+
+def ostree_delta_path(from_sha: Optional[str], to_sha: str, repo: str = None) -> Path:
+  # Where the parts of a static delta live; from_sha None means from scratch
+  name = delta_name(to_sha) if from_sha is None else f"{delta_name(from_sha)}-{delta_name(to_sha)}"
+  return ostree_repo_path(repo).joinpath('deltas', name[:2], name[2:])
+
+
+def delta_checksum(name: str) -> str:
+  return base64.b64decode(name.replace('_', '/') + '=').hex()
+
+
+def ostree_deltas(repo: str = None) -> List[Tuple[Optional[str], str]]:
+  # (from, to) for each static delta in the repo; from is None for deltas
+  # from scratch
+  deltas = []
+  root = ostree_repo_path(repo).joinpath('deltas')
+  if not root.is_dir():
+    return deltas
+
+  for prefix in root.iterdir():
+    for entry in prefix.iterdir():
+      from_name, _, to_name = (prefix.name + entry.name).rpartition('-')
+      deltas.append((delta_checksum(from_name) if len(from_name) > 0 else None, delta_checksum(to_name)))
+
+  return deltas
+
+
+def ostree_ls(ref: str) -> List[str]:
+  # Every path in a commit, relative to its root, without checking it out
+  paths = []
+  for line in capture_output('ostree', 'ls', '-R', ref).splitlines():
+    mode, _, _, _, path = line.split(None, 4)
+    if mode.startswith('l'):
+      path = path.rsplit(' -> ', 1)[0]
+    if path != '/':
+      paths.append(path[1:])
+  return paths
+
+
+def ostree_index(repo: str = None) -> Dict[str, dict]:
+  # Reads the refs and commit objects straight from the repo, rather than
+  # asking ostree about each ref in turn
+  index = {}
+
+  for ref, sha in ostree_refs(repo).items():
+    try:
+      metadata = ostree_read_commit(sha, repo)['metadata']
+    except FileNotFoundError:
+      # Probably a ref pulled with --commit-metadata-only or similar
+      continue
+
+    if f"{METADATA_PREFIX}digest" not in metadata:
+      continue
+
+    entry = {'commit': sha}
+    for key in ['digest', 'source', 'imported', 'schema']:
+      entry[key] = metadata.get(METADATA_PREFIX + key)
+    index[ref] = entry
+
+  return index
@@ -1,12 +1,11 @@
 import json
 import os
 import shutil
-import subprocess
 import tempfile
 
 from pathlib import Path
 from typing import Tuple
-from podracer.poststop import generate_hook
+from podracer.poststop import generate_hook, mount
 
 PODRACER_RUNDIR = Path(os.environ.get('PODRACER_RUNDIR', '/run/podracer'))
 
@@ -27,7 +26,6 @@ def podracer_overlay(rundir: Path, rootfs: Path) -> Tuple[Path, Path]:
   with open(hooks.joinpath('cleanup.json'), 'w') as io:
     json.dump(generate_hook(rundir), io)
 
-  mount_options = f'-olowerdir={rootfs},upperdir={upperdir},workdir={workdir}'
-  subprocess.run(['mount', '-t', 'overlay', 'overlay', mount_options, str(overlay)], check=True)
+  mount('overlay', 'overlay', overlay, f'lowerdir={rootfs},upperdir={upperdir},workdir={workdir}')
 
   return overlay, hooks
@@ -4,3 +4,5 @@ from pathlib import Path
 
 PODRACER_RUNDIR = Path(os.environ.get('PODRACER_RUNDIR', '/run/podracer'))
 PODRACER_LIBDIR = Path(os.environ.get('PODRACER_LIBDIR', '/var/lib/podracer'))
+PODRACER_SOCKET = Path(os.environ.get('PODRACER_SOCKET', str(PODRACER_RUNDIR.joinpath('podracerd.sock'))))
+PODRACER_MIRROR = Path(os.environ['PODRACER_MIRROR']) if len(os.environ.get('PODRACER_MIRROR', '')) > 0 else None
@@ -1,28 +1,185 @@
+import ctypes
+import ctypes.util
+import fcntl
 import json
 import os
 import shutil
 import subprocess
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
 
 # It's important to only import from the stdlib here, because the hook
 # instructs podman to run this file directly from the interpreter; you
 # can't count on anything but the stdlib to be available to import.
 
+GRAVEYARD_NAME = '.graveyard'
+REAPER_WORKERS = int(os.environ.get('PODRACER_REAPER_WORKERS', '4'))
+REAPER_NICE = int(os.environ.get('PODRACER_REAPER_NICE', '10'))
+REAPER_IONICE = os.environ.get('PODRACER_REAPER_IONICE', '7')
+
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'aarch64': 30, 'ppc64le': 273, 's390x': 282}
+
+
+def load_libc() -> Optional[ctypes.CDLL]:
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+  except OSError:
+    return None
+
+  if not hasattr(libc, 'mount') or not hasattr(libc, 'umount2'):
+    return None
+
+  libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+  libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+  return libc
+
+
+LIBC = load_libc()
+
+
+def mount(fstype: str, source: str, target: Union[str, Path], options: str, helper: bool = False) -> None:
+  # Calls mount(2) directly rather than forking mount(8), unless there's no
+  # usable libc to do it with
+  if helper or LIBC is None:
+    subprocess.run(['mount', '-t', fstype, source, f"-o{options}", str(target)], check=True)
+    return
+
+  if LIBC.mount(source.encode(), str(target).encode(), fstype.encode(), 0, options.encode()) != 0:
+    errno = ctypes.get_errno()
+    raise OSError(errno, f"Couldn't mount {fstype} on {target}: {os.strerror(errno)}")
+
+
+def umount(target: Union[str, Path], helper: bool = False) -> None:
+  if helper or LIBC is None:
+    subprocess.run(['umount', str(target)], check=True)
+    return
+
+  if LIBC.umount2(str(target).encode(), 0) != 0:
+    errno = ctypes.get_errno()
+    raise OSError(errno, f"Couldn't unmount {target}: {os.strerror(errno)}")
+
 
 def generate_hook(rundir: Union[str, Path]) -> dict:
   hook = {
     'cmds': ['.*'],
     'hook': sys.executable,
-    'arguments': [str(Path(__file__).absolute()), str(Path(rundir).absolute())],
+    # -S skips site-packages; this file only needs the stdlib anyway
+    'arguments': ['-S', str(Path(__file__).absolute()), str(Path(rundir).absolute())],
     'stages': ['poststop']
   }
 
   return hook
 
 
+def set_ionice(ionice: str) -> None:
+  # 'idle', or a best-effort level from 0 (highest) to 7 (lowest)
+  if ionice == 'idle':
+    priority = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+  else:
+    priority = (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | int(ionice)
+
+  syscall = IOPRIO_SET_SYSCALLS.get(os.uname().machine)
+  if LIBC is None or syscall is None:
+    return
+
+  LIBC.syscall(syscall, IOPRIO_WHO_PROCESS, 0, priority)
+
+
+def clear_directory(path: str) -> List[str]:
+  subdirectories = []
+  with os.scandir(path) as entries:
+    for entry in entries:
+      if entry.is_dir(follow_symlinks=False):
+        subdirectories.append(entry.path)
+      else:
+        os.unlink(entry.path)
+  return subdirectories
+
+
+def remove_tree(root: str, executor: ThreadPoolExecutor) -> None:
+  # Empties each level of the tree with several directories in flight at
+  # once, then removes the directories themselves deepest first
+  directories = []
+  level = [root]
+  while len(level) > 0:
+    directories += level
+    level = [subdirectory for subdirectories in executor.map(clear_directory, level) for subdirectory in subdirectories]
+
+  for directory in reversed(directories):
+    os.rmdir(directory)
+
+
+def graveyard_backlog(graveyard: Union[str, Path]) -> Tuple[int, int]:
+  entries = 0
+  size = 0
+  if not os.path.isdir(graveyard):
+    return entries, size
+
+  for entry in os.scandir(graveyard):
+    if entry.name.startswith('.'):
+      continue
+    entries += 1
+    for dirpath, dirnames, filenames in os.walk(entry.path):
+      for name in dirnames + filenames:
+        try:
+          size += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+        except FileNotFoundError:
+          # The reaper got there first
+          pass
+
+  return entries, size
+
+
+def reap(graveyard: Union[str, Path], workers: int = REAPER_WORKERS) -> int:
+  graveyard = Path(graveyard)
+  if not graveyard.is_dir():
+    return 0
+
+  fd = os.open(graveyard.joinpath('.reaper.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+  try:
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      # Another reaper is already on it, and will pick up new arrivals
+      return 0
+
+    reaped = 0
+    # Graves we couldn't remove, say because something is still mounted in
+    # them; they're left for the next reaper rather than retried forever
+    failed = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      while True:
+        graves = [entry.path for entry in os.scandir(graveyard) if not entry.name.startswith('.') and entry.path not in failed]
+        if len(graves) < 1:
+          return reaped
+
+        for grave in graves:
+          try:
+            remove_tree(grave, executor)
+          except OSError:
+            shutil.rmtree(grave, ignore_errors=True)
+
+          if os.path.lexists(grave):
+            failed.add(grave)
+          else:
+            reaped += 1
+  finally:
+    os.close(fd)
+
+
+def spawn_reaper(graveyard: Path) -> None:
+  # Detached, so neither podman nor podracer-run waits for it
+  subprocess.Popen([sys.executable, '-S', str(Path(__file__).absolute()), '--reap', str(graveyard)],
+                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
 def poststop(rundir: Union[str, Path]) -> None:
   rundir = Path(rundir).absolute()
   if not rundir.is_dir():
@@ -30,15 +187,31 @@ def poststop(rundir: Union[str, Path]) -> None:
 
   for child in rundir.iterdir():
     if os.path.ismount(child):
-      subprocess.run(['umount', str(child)], check=True)
+      umount(child)
 
   if os.path.ismount(rundir):
-    subprocess.run(['umount', str(rundir)], check=True)
+    umount(rundir)
 
-  shutil.rmtree(rundir)
+  # Deleting a big upperdir can take a long time, so move it out of the way
+  # and let the reaper take care of it
+  graveyard = rundir.parent.joinpath(GRAVEYARD_NAME)
+  try:
+    graveyard.mkdir(mode=0o700, exist_ok=True)
+    os.rename(rundir, graveyard.joinpath(rundir.name))
+  except OSError:
+    shutil.rmtree(rundir)
+    return
+
+  spawn_reaper(graveyard)
 
 
 def main(argv: List[str] = sys.argv[1:]) -> int:
+  if len(argv) == 2 and argv[0] == '--reap':
+    os.nice(REAPER_NICE)
+    set_ionice(REAPER_IONICE)
+    reap(argv[1])
+    return 0
+
   if len(argv) != 1:
     raise RuntimeError('This script takes exactly one argument')
 
@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from podracer.ostree import METADATA_PREFIX, ostree_deltas, ostree_history, ostree_index, ostree_read_commit, ostree_refs, ostree_repo_path
+from podracer.repack import LAYER_REF_PREFIX, layer_ref, ostree_update_summary
+from typing import Dict, Iterable, List, Set, Tuple
+
+PIN_REF_PREFIX = 'podracer/pins/'
+
+PRUNE_KEEP = 3
+LAYER_GRACE = 3600
+
+
+def read_pins(paths: Iterable[str]) -> Set[str]:
+  # One digest per line; blank lines and comments are ignored
+  pins = set()
+  for path in paths:
+    with open(path) as io:
+      for line in io:
+        line = line.split('#', 1)[0].strip()
+        if len(line) > 0:
+          pins.add(line)
+  return pins
+
+
+def repo_size(repo: str = None) -> int:
+  size = 0
+  for name in ['objects', 'deltas']:
+    for dirpath, _, filenames in os.walk(ostree_repo_path(repo).joinpath(name)):
+      for filename in filenames:
+        try:
+          size += os.lstat(os.path.join(dirpath, filename)).st_size
+        except FileNotFoundError:
+          pass
+  return size
+
+
+def plan_branches(index: Dict[str, dict], keep: int, keep_days: float = None, pins: Set[str] = set(), now: float = None) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, str], Set[str]]:
+  # How many commits to keep on each branch imported by podracer-repack and
+  # how many that trims, older commits to keep anyway with a ref of their
+  # own, and the diff IDs of every layer the kept commits were made from
+  cutoff = (now or time.time()) - keep_days * 86400 if keep_days is not None else None
+  depths = {}
+  trimmed = {}
+  pinned = {}
+  diff_ids = set()
+
+  for ref, entry in index.items():
+    if ref.startswith(PIN_REF_PREFIX):
+      # Once its branch is trimmed, a pinned commit is only reachable from
+      # its own ref
+      if entry['digest'] in pins:
+        pinned[ref] = entry['commit']
+        layers = ostree_read_commit(entry['commit'])['metadata'].get(METADATA_PREFIX + 'diff-ids')
+        if layers:
+          diff_ids.update(layers.split(','))
+      continue
+
+    history = ostree_history(entry['commit'])
+    depth = min(keep, len(history))
+    if cutoff is not None:
+      while depth < len(history) and history[depth][1]['timestamp'] >= cutoff:
+        depth += 1
+
+    depths[ref] = depth
+    trimmed[ref] = 0
+
+    for position, (sha, commit) in enumerate(history):
+      metadata = commit['metadata']
+      if position >= depth:
+        if metadata.get(METADATA_PREFIX + 'digest') not in pins:
+          trimmed[ref] += 1
+          continue
+        pinned[PIN_REF_PREFIX + sha] = sha
+
+      layers = metadata.get(METADATA_PREFIX + 'diff-ids')
+      if layers:
+        diff_ids.update(layers.split(','))
+
+  return depths, trimmed, pinned, diff_ids
+
+
+def unused_layers(refs: Dict[str, str], diff_ids: Set[str], grace: float = LAYER_GRACE) -> List[str]:
+  # Layer refs no kept commit was made from; recent ones may be for a
+  # repack that's still running
+  unused = []
+  for ref, sha in refs.items():
+    if not ref.startswith(LAYER_REF_PREFIX):
+      continue
+
+    algorithm, _, hexdigest = ref[len(LAYER_REF_PREFIX):].partition('/')
+    if layer_ref(f"{algorithm}:{hexdigest}") != ref or f"{algorithm}:{hexdigest}" in diff_ids:
+      continue
+
+    try:
+      timestamp = ostree_read_commit(sha)['timestamp']
+    except FileNotFoundError:
+      timestamp = 0
+    if time.time() - timestamp >= grace:
+      unused.append(ref)
+
+  return sorted(unused)
+
+
+def stale_deltas(refs: Dict[str, str]) -> List[str]:
+  # Deltas to anything but the tip of a ref are never used for updates, and
+  # ones from a pruned commit serve devices we no longer support
+  tips = set(refs.values())
+  stale = []
+
+  for from_sha, to_sha in ostree_deltas():
+    if to_sha in tips and (from_sha is None or commit_exists(from_sha)):
+      continue
+    stale.append(to_sha if from_sha is None else f"{from_sha}-{to_sha}")
+
+  return sorted(stale)
+
+
+def commit_exists(sha: str) -> bool:
+  return ostree_repo_path().joinpath('objects', sha[:2], f"{sha[2:]}.commit").exists()
+
+
+def prune_argv(depths: Dict[str, int]) -> List[str]:
+  # Other refs, like layer commits, keep their whole history
+  argv = ['ostree', 'prune', '--refs-only']
+  for ref, depth in sorted(depths.items()):
+    argv += [f"--only-branch={ref}", f"--retain-branch-depth={ref}={depth - 1}"]
+  return argv
+
+
+def prune(keep: int = PRUNE_KEEP, keep_days: float = None, pins: Set[str] = set(), keep_layers: bool = False, sign_by: str = None, dry_run: bool = False) -> dict:
+  index = ostree_index()
+  refs = ostree_refs()
+  depths, trimmed, pinned, diff_ids = plan_branches(index, keep, keep_days, pins)
+
+  unpinned = sorted(ref for ref in refs if ref.startswith(PIN_REF_PREFIX) and ref not in pinned)
+  layers = [] if keep_layers else unused_layers(refs, diff_ids)
+
+  report = {
+    'commits': sum(trimmed.values()),
+    'pinned': len(pinned),
+    'layers': len(layers),
+    'deltas': None,
+    'bytes': None,
+  }
+
+  for ref, count in sorted(trimmed.items()):
+    if count > 0:
+      sys.stderr.write(f"TRIMMED: {count} commits from {ref}, keeping {depths[ref]}\n")
+
+  if dry_run:
+    for ref in layers:
+      sys.stderr.write(f"UNUSED: {ref}\n")
+    return report
+
+  before = repo_size()
+
+  for ref, sha in sorted(pinned.items()):
+    if refs.get(ref) != sha:
+      subprocess.run(['ostree', 'refs', f"--create={ref}", sha], check=True)
+  for ref in unpinned + layers:
+    subprocess.run(['ostree', 'refs', '--delete', ref], check=True)
+    sys.stderr.write(f"REMOVED: {ref}\n")
+
+  # A pin keeps its commit, but not the history behind it
+  subprocess.run(prune_argv({**depths, **{ref: 1 for ref in pinned}}), stdout=subprocess.DEVNULL, check=True)
+
+  refs = ostree_refs()
+  deltas = stale_deltas(refs)
+  for delta in deltas:
+    subprocess.run(['ostree', 'static-delta', 'delete', delta], stdout=subprocess.DEVNULL, check=True)
+  report['deltas'] = len(deltas)
+
+  # The summary would otherwise still list what's gone
+  if ostree_repo_path().joinpath('summary').exists():
+    ostree_update_summary(sign_by)
+
+  report['bytes'] = before - repo_size()
+  sys.stderr.write(f"RECLAIMED: {report['bytes']} bytes\n")
+  return report
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='Trim the history of branches imported by podracer-repack, and prune what nothing needs')
+  parser.add_argument('--repo', metavar='OSTREE', help='ostree repo to prune')
+  parser.add_argument('--keep', metavar='N', type=int, default=PRUNE_KEEP, help=f"commits to keep on each branch, newest first (default {PRUNE_KEEP})")
+  parser.add_argument('--keep-days', metavar='DAYS', type=float, help='also keep every commit made in the last DAYS days')
+  parser.add_argument('--pin', metavar='DIGEST', action='append', default=[], help='never remove commits of this image digest; may be repeated')
+  parser.add_argument('--pins', metavar='FILE', action='append', default=[], help='read digests to pin from FILE, one per line; may be repeated')
+  parser.add_argument('--keep-layers', action='store_true', help="don't remove layer commits no kept commit was made from")
+  parser.add_argument('--sign-by', metavar='KEYID', help='sign the updated summary with GPG key')
+  parser.add_argument('--dry-run', action='store_true', help='only print what would be removed')
+  args = parser.parse_args(argv)
+
+  if args.keep < 1:
+    parser.error('--keep must be at least 1')
+
+  if args.repo is not None:
+    os.environ['OSTREE_REPO'] = args.repo
+
+  report = prune(args.keep, args.keep_days, set(args.pin) | read_pins(args.pins), args.keep_layers, args.sign_by, args.dry_run)
+  print(json.dumps(report))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,33 @@
+import argparse
+import json
+import sys
+
+from podracer.ostree import ostree_index
+from typing import List
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+  parser = argparse.ArgumentParser(description='List refs imported by podracer-repack')
+  parser.add_argument('prefix', metavar='PREFIX', nargs='?', help='only list refs starting with PREFIX')
+  parser.add_argument('--repo', metavar='OSTREE', help='ostree repo to read')
+  parser.add_argument('--output', metavar='yaml|json', help='output format')
+  args = parser.parse_args(argv)
+
+  index = ostree_index(args.repo)
+  refs = sorted(ref for ref in index if args.prefix is None or ref.startswith(args.prefix))
+
+  if args.output is None or args.output == 'yaml':
+    for ref in refs:
+      print(f"- ref: {ref}")
+      for key in ['commit', 'digest', 'source', 'imported']:
+        print(f"  {key}: {index[ref][key]}")
+  elif args.output == 'json':
+    print(json.dumps({ref: index[ref] for ref in refs}, indent=2))
+  else:
+    raise RuntimeError(f"Unknown output format: {args.output}")
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,12 +1,27 @@
+import asyncio
+import errno
+import hashlib
 import json
 import os
-
-from http.client import HTTPResponse
+import random
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection, IncompleteRead, RemoteDisconnected
+from io import BytesIO
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from podracer.cache import LayerCache, ManifestCache
+from typing import AsyncIterator, Callable, Dict, IO, Iterable, Iterator, List, Optional, Tuple
 from urllib.error import HTTPError
 from urllib.parse import urlencode, urljoin, urlparse
-from urllib.request import Request, urlopen
 
 MANIFEST_V2_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
 MANIFEST_LIST_TYPE = 'application/vnd.docker.distribution.manifest.list.v2+json'
@@ -14,15 +29,43 @@ IMAGE_TYPE = 'application/vnd.docker.container.image.v1+json'
 
 DOCKERHUB_ALIASES = ['docker.io', 'registry-1.docker.io', 'https://index.docker.io/v1/']
 
+# Registries to talk to over plain HTTP, e.g. a local mirror or test registry
+INSECURE_REGISTRIES = [registry for registry in os.environ.get('PODRACER_INSECURE_REGISTRIES', '').split(',') if len(registry) > 0]
+
+BLOB_CHUNK_SIZE = 1024 * 1024
+BLOB_RETRIES = int(os.environ.get('PODRACER_BLOB_RETRIES', '5'))
+RETRY_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+RETRY_ERRNOS = [errno.ENETDOWN, errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ETIMEDOUT]
+
+# Blobs at least RANGE_MIN_SIZE are fetched as this many byte ranges at once
+RANGE_CHUNKS = int(os.environ.get('PODRACER_RANGE_CHUNKS', '1'))
+RANGE_MIN_SIZE = 32 * 1024 * 1024
+PULL_JOBS = 4
+MANIFEST_JOBS = 16
+
+REQUEST_TIMEOUT = 60
+MAX_REDIRECTS = 5
+DRAIN_LIMIT = 64 * 1024
+DEFAULT_TOKEN_LIFETIME = 60
+TOKEN_SLACK = 10
+
+DEFAULT_CLIENT = None
+DEFAULT_CLIENT_LOCK = threading.Lock()
+
 
 def qualify_image(image: str) -> str:
-  if len(image.split('/')) < 2:
-    image = 'library/' + image
+  # Like docker, only treat the first component as a registry if it looks
+  # like a hostname, so localhost:5000/image works
+  registry, _, repository = image.partition('/')
+  if len(repository) < 1 or ('.' not in registry and ':' not in registry and registry != 'localhost'):
+    registry, repository = 'registry-1.docker.io', image
 
-  if len(image.split('/')) < 3:
-    image = 'registry-1.docker.io/' + image
+  if registry in DOCKERHUB_ALIASES and '/' not in repository:
+    repository = 'library/' + repository
+  image = f"{registry}/{repository}"
 
-  if len(image.split(':')) < 2:
+  if ':' not in image.rsplit('/', 1)[1]:
     image += ':latest'
 
   return image
@@ -64,54 +107,201 @@ def registry_credentials(registry: str) -> Optional[str]:
   return None
 
 
-def registry_request(url: str, headers: Dict[str, str] = {}, token: str = None, method: str = 'GET') -> Tuple[HTTPResponse, Optional[str]]:
-  try:
-    if token is not None:
-      headers['Authorization'] = f"Bearer {token}"
+def parse_challenge(header: str) -> Tuple[str, Dict[str, str]]:
+  auth_type, fields = header.split(None, 1)
 
-    response = urlopen(Request(url, headers=headers, method=method))
-    return response, token
-  except HTTPError as error:
-    if (error.code != 401) or (token is not None):
-      raise
+  if auth_type != 'Bearer':
+    raise RuntimeError(f"Don't know how to handle '{auth_type}' auth")
 
-    auth_header = error.headers['Www-Authenticate']
-    auth_type, fields = auth_header.split(None, 1)
+  # Values are quoted, and scopes can contain commas
+  params = dict(re.findall(r'(\w+)="([^"]*)"', fields))
 
-    if auth_type != 'Bearer':
-      raise RuntimeError(f"Don't know how to handle '{auth_type}' auth")
+  if 'realm' not in params:
+    raise RuntimeError("No realm in Www-Authenticate header")
 
-    realm = None
-    params = []
+  return params.pop('realm'), params
 
-    for field in fields.split(','):
-      key, value = field.split('=', 1)
-      value = value.strip('"')
 
-      if key == 'realm':
-        realm = value
-      else:
-        params.append(f"{key}={value}")
+def request_scope(url: str) -> Optional[str]:
+  match = re.match(r'/v2/(.+)/(manifests|blobs|tags)/', urlparse(url).path)
+  if match is None:
+    return None
+  return f"repository:{match.group(1)}:pull"
+
+
+class RegistryClient:
+  # Keeps connections to each host open between requests, and remembers
+  # bearer tokens (until they expire) and credentials for each registry
+  def __init__(self, timeout: float = REQUEST_TIMEOUT):
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    self.connections: Dict[Tuple[str, str], List[HTTPConnection]] = {}
+    self.challenges: Dict[str, Tuple[str, Dict[str, str]]] = {}
+    self.tokens: Dict[Tuple[str, str], Tuple[str, float]] = {}
+    self.credentials: Dict[str, Optional[str]] = {}
+
+
+  def connect(self, scheme: str, netloc: str) -> Tuple[HTTPConnection, bool]:
+    with self.lock:
+      idle = self.connections.get((scheme, netloc), [])
+      if len(idle) > 0:
+        return idle.pop(), True
+
+    if scheme == 'https':
+      return HTTPSConnection(netloc, timeout=self.timeout), False
+    else:
+      return HTTPConnection(netloc, timeout=self.timeout), False
+
+
+  def release(self, scheme: str, netloc: str, connection: HTTPConnection, response: HTTPResponse) -> None:
+    if not response.isclosed() and (response.length is not None) and (response.length <= DRAIN_LIMIT):
+      # Cheaper to read what's left than to reconnect
+      response.read()
+
+    if response.isclosed() and not response.will_close:
+      with self.lock:
+        self.connections.setdefault((scheme, netloc), []).append(connection)
+    else:
+      connection.close()
+
+
+  def send(self, url: str, headers: Dict[str, str], method: str) -> Tuple[HTTPResponse, Callable[[], None]]:
+    for _ in range(MAX_REDIRECTS):
+      parsed = urlparse(url)
+      path = parsed.path + (f"?{parsed.query}" if len(parsed.query) > 0 else '')
+
+      connection, reused = self.connect(parsed.scheme, parsed.netloc)
+      try:
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+      except (RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        connection.close()
+        if not reused:
+          raise
+        # The server closed an idle connection; try again on a new one
+        connection, _ = self.connect(parsed.scheme, parsed.netloc)
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+      except:
+        connection.close()
+        raise
+
+      release = lambda parsed=parsed, connection=connection, response=response: self.release(parsed.scheme, parsed.netloc, connection, response)
+
+      if response.status not in [301, 302, 303, 307, 308]:
+        return response, release
+
+      location = response.headers['Location']
+      release()
+
+      url = urljoin(url, location)
+      if urlparse(url).netloc != parsed.netloc:
+        # Blob downloads usually redirect to a CDN, which won't want our token
+        headers = {key: value for key, value in headers.items() if key != 'Authorization'}
+      if response.status == 303:
+        method = 'GET'
+
+    raise RuntimeError(f"Too many redirects fetching {url}")
+
+
+  def registry_credentials(self, registry: str) -> Optional[str]:
+    with self.lock:
+      if registry in self.credentials:
+        return self.credentials[registry]
+
+    credentials = registry_credentials(registry)
+    with self.lock:
+      self.credentials[registry] = credentials
+    return credentials
+
+
+  def token(self, registry: str, scope: Optional[str], refresh: bool = False) -> Optional[str]:
+    with self.lock:
+      if registry not in self.challenges:
+        return None
+      realm, params = self.challenges[registry]
+      params = dict(params)
+      if scope is not None:
+        params['scope'] = scope
+
+      key = (realm, params.get('scope', ''))
+      if not refresh and key in self.tokens:
+        token, expires = self.tokens[key]
+        if time.monotonic() < expires:
+          return token
+
+    headers = {}
+    credentials = self.registry_credentials(registry)
+    if credentials is not None:
+      headers['Authorization'] = f"Basic {credentials}"
+
+    response, release = self.send(realm + '?' + urlencode(params), headers, 'GET')
+    try:
+      if response.status >= 400:
+        raise HTTPError(realm, response.status, response.reason, response.headers, BytesIO(response.read()))
+      auth = json.load(response)
+    finally:
+      release()
+
+    token = auth.get('token', auth.get('access_token'))
+    if token is None:
+      raise RuntimeError("No token in response")
 
-    if realm is None:
-      raise RuntimeError("No realm in Www-Authenticate header")
+    # Leave some slack so a token doesn't expire on its way to the registry
+    expires = time.monotonic() + max(auth.get('expires_in', DEFAULT_TOKEN_LIFETIME) - TOKEN_SLACK, 0)
+    with self.lock:
+      self.tokens[key] = (token, expires)
+    return token
 
-    auth_headers = {}
-    credentials = registry_credentials(urlparse(url).netloc)
-    if credentials is not None:
-      auth_headers = {'Authorization': f"Basic {credentials}"}
 
-    response = urlopen(Request(realm + '?' + '&'.join(params), headers=auth_headers))
-    auth = json.load(response)
-    response.close()
+  @contextmanager
+  def request(self, url: str, headers: Dict[str, str] = {}, method: str = 'GET') -> Iterator[HTTPResponse]:
+    registry = urlparse(url).netloc
+    scope = request_scope(url)
+    headers = dict(headers)
 
-    if 'token' not in auth:
-      raise RuntimeError("No token in response")
+    # Once we've seen a registry's challenge, send a token up front
+    token = self.token(registry, scope)
+    if token is not None:
+      headers['Authorization'] = f"Bearer {token}"
+
+    response, release = self.send(url, headers, method)
+
+    if response.status == 401:
+      challenge = response.headers['Www-Authenticate']
+      release()
+
+      realm, params = parse_challenge(challenge)
+      scope = params.pop('scope', scope)
+      with self.lock:
+        self.challenges[registry] = (realm, params)
+
+      # A token we sent was rejected, most likely because it expired
+      headers['Authorization'] = f"Bearer {self.token(registry, scope, refresh=token is not None)}"
+      response, release = self.send(url, headers, method)
 
-    return registry_request(url, headers, auth['token'], method)
+    try:
+      if response.status >= 400:
+        raise HTTPError(url, response.status, response.reason, response.headers, BytesIO(response.read()))
+      yield response
+    finally:
+      release()
 
 
-def get_manifests(image: str) -> List[dict]:
+def default_client() -> RegistryClient:
+  global DEFAULT_CLIENT
+  with DEFAULT_CLIENT_LOCK:
+    if DEFAULT_CLIENT is None:
+      DEFAULT_CLIENT = RegistryClient()
+    return DEFAULT_CLIENT
+
+
+def registry_url(base_url: str) -> str:
+  scheme = 'http' if base_url in INSECURE_REGISTRIES else 'https'
+  return f"{scheme}://{base_url}"
+
+
+def parse_image(image: str) -> Tuple[str, str, str]:
   image = qualify_image(image)
   base_url, image = image.split('/', 1)
   repository, tag = image.split(':', 1)
@@ -119,18 +309,38 @@ def get_manifests(image: str) -> List[dict]:
   if base_url in DOCKERHUB_ALIASES:
     base_url = 'registry-1.docker.io'
 
-  url = f"https://{base_url}/v2/{repository}/manifests/{tag}"
+  return base_url, repository, tag
+
+
+def get_manifests(image: str, client: RegistryClient = None, cache: ManifestCache = None) -> List[dict]:
+  client = client or default_client()
+  base_url, repository, tag = parse_image(image)
+
+  url = f"{registry_url(base_url)}/v2/{repository}/manifests/{tag}"
   headers = {"Accept": f"{MANIFEST_LIST_TYPE}, {MANIFEST_V2_TYPE}"}
 
-  response, token = registry_request(url, headers)
-  body = json.load(response)
-  response.close()
+  cached = cache.load(image) if cache is not None else None
+  if cached is not None:
+    # A HEAD is enough to tell whether the tag still points at the same thing
+    with client.request(url, headers, method='HEAD') as response:
+      digest = response.headers['Docker-Content-Digest']
+
+    if (digest is not None) and (digest == cached['digest']):
+      return cached['manifests']
+
+    if (digest is None) and (cached['etag'] is not None):
+      headers['If-None-Match'] = cached['etag']
+
+  with client.request(url, headers) as response:
+    if response.status == 304:
+      return cached['manifests']
+    body = json.load(response)
 
   content_type = response.headers['Content-Type']
 
   if content_type == MANIFEST_LIST_TYPE:
     # manifest lists are easy and need no further processing
-    return body['manifests']
+    manifests = body['manifests']
   elif content_type == MANIFEST_V2_TYPE:
     # ugh, we have to actually fetch the image
     if body['config']['mediaType'] != IMAGE_TYPE:
@@ -138,18 +348,384 @@ def get_manifests(image: str) -> List[dict]:
 
     manifest = {'digest': response.headers['Docker-Content-Digest']}
 
-    url = f"https://{base_url}/v2/{repository}/blobs/{body['config']['digest']}"
+    url = f"{registry_url(base_url)}/v2/{repository}/blobs/{body['config']['digest']}"
     headers = {"Accept": IMAGE_TYPE}
 
-    response, token = registry_request(url, headers, token)
-    body = json.load(response)
-    response.close()
+    with client.request(url, headers) as config_response:
+      body = json.load(config_response)
 
     manifest['platform'] = {'architecture': body['architecture'], 'os': body['os']}
     if 'variant' in body:
       manifest['platform']['variant'] = body['variant']
 
-    return [manifest]
+    manifests = [manifest]
   else:
     # who knows what this is?
     raise RuntimeError(f"Unknown content type: {content_type}")
+
+  if cache is not None:
+    cache.save(image, manifests, response.headers['Docker-Content-Digest'], response.headers['ETag'])
+
+  return manifests
+
+
+class AsyncRegistryClient:
+  # Lets asyncio code wait on many registry requests at once. Each request
+  # still runs on the blocking client, on a pool of at most jobs threads, so
+  # they share its connections and tokens and never exceed that limit
+  def __init__(self, client: RegistryClient = None, jobs: int = MANIFEST_JOBS):
+    self.client = client or default_client()
+    self.executor = ThreadPoolExecutor(max_workers=jobs)
+
+
+  async def __aenter__(self) -> 'AsyncRegistryClient':
+    return self
+
+
+  async def __aexit__(self, *args) -> None:
+    self.close()
+
+
+  def close(self) -> None:
+    self.executor.shutdown(wait=False)
+
+
+  async def call(self, function: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor, partial(function, *args, client=self.client, **kwargs))
+
+
+  async def get_manifests(self, image: str, cache: ManifestCache = None) -> List[dict]:
+    return await self.call(get_manifests, image, cache=cache)
+
+
+  async def inspect(self, images: Iterable[str], cache: ManifestCache = None) -> AsyncIterator[Tuple[str, Optional[List[dict]], Optional[Exception]]]:
+    # Yields (image, manifests, error) in whatever order they finish, so
+    # one slow registry doesn't hold up the rest
+    async def inspect_one(image: str) -> Tuple[str, Optional[List[dict]], Optional[Exception]]:
+      try:
+        return image, await self.get_manifests(image, cache), None
+      except Exception as error:
+        return image, None, error
+
+    for result in asyncio.as_completed([inspect_one(image) for image in images]):
+      yield await result
+
+
+def check_digest(expected: str, sha256: str) -> None:
+  if expected != f"sha256:{sha256}":
+    raise RuntimeError(f"Digest mismatch: expected {expected}, got sha256:{sha256}")
+
+
+def get_manifest(image: str, digest: str, client: RegistryClient = None) -> dict:
+  client = client or default_client()
+  base_url, repository, _ = parse_image(image)
+
+  url = f"{registry_url(base_url)}/v2/{repository}/manifests/{digest}"
+  headers = {"Accept": MANIFEST_V2_TYPE}
+
+  with client.request(url, headers) as response:
+    body = response.read()
+
+  content_type = response.headers['Content-Type']
+  if content_type != MANIFEST_V2_TYPE:
+    raise RuntimeError(f"Unknown content type: {content_type}")
+
+  check_digest(digest, hashlib.sha256(body).hexdigest())
+  return json.loads(body)
+
+
+def retryable(error: Exception) -> bool:
+  # Dropped connections, timeouts and overloaded registries are worth
+  # another try; missing blobs and bad digests aren't
+  if isinstance(error, HTTPError):
+    return error.code == 429 or error.code >= 500
+  if isinstance(error, (ConnectionError, socket.timeout, socket.gaierror, HTTPException)):
+    return True
+  return isinstance(error, OSError) and error.errno in RETRY_ERRNOS
+
+
+def get_range(url: str, write: Callable[[bytes], None], start: int = 0, end: int = None, client: RegistryClient = None) -> int:
+  # Passes bytes start to end (or the end of the blob) to write, picking up
+  # where it left off with a Range request if the transfer is cut short;
+  # returns how far it got
+  client = client or default_client()
+  offset = start
+  failures = 0
+
+  while end is None or offset < end:
+    headers = {}
+    if offset > 0 or end is not None:
+      headers['Range'] = f"bytes={offset}-{end - 1 if end is not None else ''}"
+
+    progress = offset
+    try:
+      with client.request(url, headers) as response:
+        # Servers that ignore Range send the whole blob
+        skip = offset if response.status == 200 else 0
+        if response.status == 206 and not response.headers.get('Content-Range', '').startswith(f"bytes {offset}-"):
+          raise RuntimeError(f"Asked for {url} from byte {offset}, got {response.headers.get('Content-Range')}")
+
+        while end is None or offset < end:
+          chunk = response.read(BLOB_CHUNK_SIZE)
+          if len(chunk) < 1:
+            break
+          if skip > 0:
+            chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+          if end is not None:
+            chunk = chunk[:end - offset]
+          write(chunk)
+          offset += len(chunk)
+
+        # http.client treats a connection closed early as the end of the body
+        if (end is None and response.length) or (end is not None and offset < end):
+          raise IncompleteRead(b'', response.length or end - offset)
+
+      if end is None:
+        return offset
+    except Exception as error:
+      if offset > progress:
+        failures = 0
+      if not retryable(error) or failures >= BLOB_RETRIES:
+        raise
+
+      delay = min(RETRY_DELAY * 2 ** failures, RETRY_MAX_DELAY) * random.uniform(0.5, 1.0)
+      failures += 1
+      sys.stderr.write(f"NOTICE: retrying {url} from byte {offset} in {delay:.1f}s; {error!r}\n")
+      time.sleep(delay)
+
+  return offset
+
+
+def get_ranges(url: str, size: int, chunks: int, client: RegistryClient = None) -> IO[bytes]:
+  # Fetches a blob as several byte ranges at once, into a temporary file
+  buffer = tempfile.TemporaryFile()
+  fd = buffer.fileno()
+
+  def get_chunk(start: int, end: int) -> None:
+    position = start
+
+    def write(chunk: bytes) -> None:
+      nonlocal position
+      view = memoryview(chunk)
+      while len(view) > 0:
+        written = os.pwrite(fd, view, position)
+        view = view[written:]
+        position += written
+
+    get_range(url, write, start, end, client)
+
+  bounds = [size * index // chunks for index in range(chunks + 1)]
+  try:
+    with ThreadPoolExecutor(max_workers=chunks) as executor:
+      for future in [executor.submit(get_chunk, start, end) for start, end in zip(bounds, bounds[1:])]:
+        future.result()
+  except:
+    buffer.close()
+    raise
+
+  return buffer
+
+
+def get_blob(image: str, digest: str, output: IO[bytes], client: RegistryClient = None, size: int = None, resume: IO[bytes] = None) -> None:
+  # resume, if given, holds what an earlier attempt downloaded, and is
+  # appended to as the rest arrives
+  client = client or default_client()
+  base_url, repository, _ = parse_image(image)
+
+  if not digest.startswith('sha256:'):
+    raise RuntimeError(f"Unsupported digest: {digest}")
+
+  url = f"{registry_url(base_url)}/v2/{repository}/blobs/{digest}"
+  hasher = hashlib.sha256()
+
+  def write(chunk: bytes) -> None:
+    hasher.update(chunk)
+    output.write(chunk)
+
+  def replay(buffer: IO[bytes]) -> None:
+    buffer.seek(0)
+    while True:
+      chunk = buffer.read(BLOB_CHUNK_SIZE)
+      if len(chunk) < 1:
+        break
+      write(chunk)
+
+  if RANGE_CHUNKS > 1 and size is not None and size >= RANGE_MIN_SIZE:
+    with get_ranges(url, size, RANGE_CHUNKS, client) as buffer:
+      replay(buffer)
+  elif resume is not None:
+    try:
+      replay(resume)
+    except:
+      # Whatever an earlier attempt left behind is no good, and would fail
+      # every later attempt the same way
+      resume.truncate(0)
+      raise
+
+    def append(chunk: bytes) -> None:
+      resume.write(chunk)
+      write(chunk)
+
+    if size is None or resume.tell() < size:
+      get_range(url, append, resume.tell(), client=client)
+  else:
+    get_range(url, write, client=client)
+
+  try:
+    check_digest(digest, hasher.hexdigest())
+  except RuntimeError:
+    if resume is not None:
+      resume.truncate(0)
+    raise
+
+
+class LayerWriter:
+  # Decompresses a layer blob as it arrives, hashing the uncompressed tar so
+  # it can be checked against the diff ID from the image config
+  def __init__(self, output: IO[bytes], media_type: str):
+    self.output = output
+    self.hasher = hashlib.sha256()
+
+    if media_type.endswith('gzip'):
+      self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    elif media_type.endswith('tar'):
+      self.decompressor = None
+    else:
+      raise RuntimeError(f"Unknown layer mediaType: {media_type}")
+
+
+  def emit(self, data: bytes) -> None:
+    self.hasher.update(data)
+    self.output.write(data)
+
+
+  def write(self, chunk: bytes) -> None:
+    if self.decompressor is None:
+      self.emit(chunk)
+      return
+
+    while len(chunk) > 0:
+      if self.decompressor.eof:
+        # Another gzip member follows the last one
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+      self.emit(self.decompressor.decompress(chunk))
+      chunk = self.decompressor.unused_data if self.decompressor.eof else b''
+
+
+  def close(self, diff_id: str) -> None:
+    if self.decompressor is not None:
+      self.emit(self.decompressor.flush())
+      if not self.decompressor.eof:
+        raise RuntimeError("Layer blob ended in the middle of a gzip stream")
+
+    check_digest(diff_id, self.hasher.hexdigest())
+
+
+def download_layer(image: str, layer: dict, diff_id: str, buffer: IO[bytes], client: RegistryClient = None, resume: IO[bytes] = None) -> None:
+  writer = LayerWriter(buffer, layer['mediaType'])
+  try:
+    get_blob(image, layer['digest'], writer, client, layer.get('size'), resume)
+    writer.close(diff_id)
+  except (RuntimeError, zlib.error):
+    # A corrupt blob, rather than a failed download; start over next time
+    if resume is not None:
+      resume.truncate(0)
+    raise
+
+
+def pull_layer(image: str, layer: dict, diff_id: str, cache: LayerCache = None, client: RegistryClient = None) -> IO[bytes]:
+  if cache is not None:
+    buffer = cache.open(layer['digest'])
+    if buffer is None:
+      with cache.partial(layer['digest']) as resume, cache.store(layer['digest']) as buffer:
+        download_layer(image, layer, diff_id, buffer, client, resume)
+    return buffer
+
+  buffer = tempfile.TemporaryFile()
+  try:
+    download_layer(image, layer, diff_id, buffer, client)
+  except:
+    buffer.close()
+    raise
+
+  buffer.seek(0)
+  return buffer
+
+
+def reopen(buffer: IO[bytes]) -> IO[bytes]:
+  # Another handle on the same file, with an offset of its own unlike dup(),
+  # which works even if the file has no name
+  return open(f"/proc/self/fd/{buffer.fileno()}", 'rb')
+
+
+class LayerPool:
+  # Pulls that run side by side, e.g. for each platform of one image, share
+  # their layers: each blob is downloaded once, and every pull of it gets
+  # its own handle on the result. The pool lets go of a layer once every
+  # pull waiting on it has its handle, so a later pull starts over
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.pulls: Dict[str, Future] = {}
+    self.waiting: Dict[str, int] = {}
+
+
+  def pull_layer(self, image: str, layer: dict, diff_id: str, cache: LayerCache = None, client: RegistryClient = None) -> IO[bytes]:
+    digest = layer['digest']
+    with self.lock:
+      pull = self.pulls.get(digest)
+      first = pull is None
+      if first:
+        pull = self.pulls[digest] = Future()
+      self.waiting[digest] = self.waiting.get(digest, 0) + 1
+
+    if first:
+      try:
+        pull.set_result(pull_layer(image, layer, diff_id, cache, client))
+      except Exception as error:
+        pull.set_exception(error)
+
+    try:
+      return reopen(pull.result())
+    finally:
+      with self.lock:
+        self.waiting[digest] -= 1
+        last = self.waiting[digest] < 1
+        if last:
+          del self.waiting[digest]
+          del self.pulls[digest]
+
+      if last and pull.exception() is None:
+        pull.result().close()
+
+
+  def close(self) -> None:
+    with self.lock:
+      pulls, self.pulls = self.pulls, {}
+      self.waiting = {}
+
+    for pull in pulls.values():
+      if pull.done() and pull.exception() is None:
+        pull.result().close()
+
+
+def pull_image(image: str, digest: str, jobs: int = PULL_JOBS, cache: LayerCache = None, client: RegistryClient = None, skip: Callable[[str], bool] = None, pool: LayerPool = None) -> Tuple[dict, List[Tuple[str, Optional[IO[bytes]]]]]:
+  # Layers skip returns True for, given their diff IDs, aren't downloaded
+  client = client or default_client()
+  pull = pool.pull_layer if pool is not None else pull_layer
+  manifest = get_manifest(image, digest, client)
+
+  config_buffer = BytesIO()
+  get_blob(image, manifest['config']['digest'], config_buffer, client)
+  config = json.loads(config_buffer.getvalue())
+
+  diff_ids = config['rootfs']['diff_ids']
+  if len(diff_ids) != len(manifest['layers']):
+    raise RuntimeError(f"Image config lists {len(diff_ids)} layers, but manifest has {len(manifest['layers'])}")
+
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    futures = [None if skip is not None and skip(diff_id) else executor.submit(pull, image, layer, diff_id, cache, client) for layer, diff_id in zip(manifest['layers'], diff_ids)]
+    layers = [(layer['digest'], None if future is None else future.result()) for layer, future in zip(manifest['layers'], futures)]
+
+  return config, layers
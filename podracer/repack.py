@@ -4,23 +4,34 @@ import json
 import os
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from pathlib import Path
-from podracer.capture import capture_output, capture_json
-from podracer.export import EXPORT_COMMAND, export_rootfs
+from podracer.cache import LAYER_CACHE_SIZE, LayerCache, ManifestCache, parse_size
+from podracer.capture import capture_output
+from podracer.export import Layer, LayerIndex, LayerListing, export_layers, make_buffer, merge_layers
 from podracer.manifests import filter_manifests
-from podracer.ostree import ostree_rev_parse
-from podracer.registry import get_manifests, qualify_image
-from typing import List, Optional
+from podracer.ostree import METADATA_PREFIX, ostree_ancestors, ostree_delta_path, ostree_index, ostree_ls, ostree_refs
+from podracer.registry import PULL_JOBS, LayerPool, get_manifests, pull_image, qualify_image
+from typing import Callable, Dict, IO, List, Optional, Set, Tuple
 
 METADATA_FILENAME = '.podracer.json'
 SCHEMA_KEY = 'podracer_schema'
 SCHEMA_VERSION = 1
 
+BATCH_WORKERS = 4
 
-def registry_manifest(image: str, arch: str, variant: str = None) -> dict:
-  manifests = get_manifests(image)
+LAYER_REF_PREFIX = 'podracer/layers/'
+
+DELTA_DEPTH = 1
+
+
+def registry_manifest(image: str, arch: str, variant: str = None, cache: ManifestCache = None) -> dict:
+  manifests = get_manifests(image, cache=cache)
   matches = list(filter_manifests(manifests, arch=arch, variant=variant, osname='linux'))
 
   if len(matches) < 1:
@@ -31,27 +42,52 @@ def registry_manifest(image: str, arch: str, variant: str = None) -> dict:
   return matches[0]
 
 
-def ostree_digest(ref: str) -> Optional[str]:
-  try:
-    metadata = capture_json('ostree', 'cat', ref, METADATA_FILENAME, suppress_stderr=True)
+def parse_platforms(platforms: str) -> List[Tuple[str, Optional[str]]]:
+  # ARCH[/VARIANT],...
+  return [(platform.partition('/')[0], platform.partition('/')[2] or None) for platform in platforms.split(',') if len(platform) > 0]
 
-    if not isinstance(metadata, dict):
-      return None
-    if SCHEMA_KEY not in metadata:
-      return None
-    if metadata[SCHEMA_KEY] != SCHEMA_VERSION:
-      return None
 
-    return metadata["digest"]
-  except subprocess.CalledProcessError:
-    return None
+def platform_ref(ref: str, platform: dict) -> str:
+  ref = f"{ref}/{platform['architecture']}"
+  if 'variant' in platform:
+    ref += f"/{platform['variant']}"
+  return ref
 
 
-def ostree_commit(ref: str, tarball: str, metadata: dict, sign_by: str = None) -> str:
+def platform_entries(ref: str, image: str, platforms: List[Tuple[str, Optional[str]]] = None, cache: ManifestCache = None) -> List[dict]:
+  # One batch entry per platform of image, all of them if platforms is None,
+  # each committing to its own branch under ref
+  manifests = list(filter_manifests(get_manifests(qualify_image(image), cache=cache), osname='linux'))
+
+  if platforms is not None:
+    matches = []
+    for arch, variant in platforms:
+      found = list(filter_manifests(manifests, arch=arch, variant=variant))
+      if len(found) < 1:
+        raise RuntimeError(f"No manifest for {arch}{'/' + variant if variant is not None else ''} in {image}")
+      matches += [manifest for manifest in found if manifest not in matches]
+    manifests = matches
+
+  if len(manifests) < 1:
+    raise RuntimeError(f"No linux manifests in {image}")
+
+  return [{
+    'branch': platform_ref(ref, manifest['platform']),
+    'image': image,
+    'arch': manifest['platform']['architecture'],
+    'variant': manifest['platform'].get('variant'),
+    'manifest': manifest,
+  } for manifest in manifests]
+
+
+def ostree_commit_argv(ref: str, tarball: str, metadata: dict, sign_by: str = None, trees: List[str] = None) -> List[str]:
+  if trees is None:
+    trees = [f"tar={tarball}"]
+
   commit_argv = [
     'ostree', 'commit', '--tar-autocreate-parents',
     f"--branch={ref}",
-    f"--tree=tar={tarball}",
+  ] + [f"--tree={tree}" for tree in trees] + [
     f"--subject=podracer repacked {metadata['source']} at {metadata['imported']}",
     f"--add-metadata-string=com.getseam.podracer.source={metadata['source']}",
     f"--add-metadata-string=com.getseam.podracer.imported={metadata['imported']}",
@@ -59,58 +95,353 @@ def ostree_commit(ref: str, tarball: str, metadata: dict, sign_by: str = None) -
     f"--add-metadata-string=com.getseam.podracer.schema={SCHEMA_VERSION}"
   ]
 
+  # Lets podracer-prune tell which layer commits are still in use
+  if 'diff_ids' in metadata:
+    commit_argv.append(f"--add-metadata-string={METADATA_PREFIX}diff-ids={','.join(metadata['diff_ids'])}")
+
   if sign_by is not None:
     commit_argv.append(f"--gpg-sign={sign_by}")
 
-  return capture_output(*commit_argv)
+  return commit_argv
+
+
+def ostree_commit(ref: str, tarball: str, metadata: dict, sign_by: str = None) -> str:
+  return capture_output(*ostree_commit_argv(ref, tarball, metadata, sign_by))
+
+
+def ostree_commit_stream(ref: str, export: Callable[[IO[bytes]], None], metadata: dict, sign_by: str = None) -> str:
+  commit_argv = ostree_commit_argv(ref, '-', metadata, sign_by)
+  child = subprocess.Popen(commit_argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr.fileno())
+
+  try:
+    # The export closes the pipe once the archive is complete
+    export(child.stdin)
+  except:
+    # Make sure ostree never sees the end of a truncated archive
+    if child.poll() is None:
+      child.kill()
+    child.wait()
+    try:
+      child.stdin.close()
+    except BrokenPipeError:
+      pass
+    if child.returncode > 0:
+      raise subprocess.CalledProcessError(child.returncode, commit_argv)
+    raise
+
+  commit = child.stdout.read().decode().strip()
+  if child.wait() != 0:
+    raise subprocess.CalledProcessError(child.returncode, commit_argv)
+
+  return commit
+
+
+def layer_ref(diff_id: str) -> str:
+  algorithm, hexdigest = diff_id.split(':', 1)
+  return f"{LAYER_REF_PREFIX}{algorithm}/{hexdigest}"
+
+
+def ostree_commit_layer(diff_id: str, buffer: IO[bytes]) -> str:
+  commit_argv = [
+    'ostree', 'commit', '--tar-autocreate-parents',
+    f"--branch={layer_ref(diff_id)}",
+    '--tree=tar=-',
+    f"--subject=podracer layer {diff_id}",
+    f"--add-metadata-string={METADATA_PREFIX}diff-id={diff_id}"
+  ]
+
+  child = subprocess.run(commit_argv, stdin=buffer, stdout=subprocess.PIPE, check=True, text=True)
+  buffer.seek(0)
+  return child.stdout.strip()
+
+
+def ostree_path(name: str) -> str:
+  # A tar member's path as ostree commit stores it
+  while name.startswith('./'):
+    name = name[2:]
+  return name.lstrip('/') if name != '.' else ''
+
+
+def layer_listing(buffer: IO[bytes], name: str) -> LayerListing:
+  # Lists a layer the way ostree_ls would list its layer commit, so names
+  # like ./usr/bin line up between the two, and with the skip list
+  paths = (ostree_path(path) for path in Layer(buffer, name).paths)
+  return LayerListing(name, [path for path in paths if len(path) > 0])
+
+
+def hidden_paths(layers: List[LayerIndex], files: Dict[str, LayerIndex], inject: Dict[str, str]) -> List[str]:
+  # Everything in the layer trees that isn't in the merged rootfs, leaving
+  # alone the parents of anything that is
+  keep = set(inject)
+  for path in files:
+    while len(path) > 0 and path not in keep:
+      keep.add(path)
+      path = path.rpartition('/')[0]
+
+  return sorted({path for layer in layers for path in layer.paths if path not in keep})
+
+
+def ostree_commit_layers(ref: str, layers: List[LayerIndex], diff_ids: List[str], inject: Dict[str, str], metadata: dict, sign_by: str = None) -> str:
+  # Unions the layer commits into one tree, skipping what whiteouts hide,
+  # so ostree only has to write the new directory metadata
+  with tempfile.TemporaryDirectory() as scratch:
+    # A tarball rather than a directory, whose owner, mode and xattrs would
+    # otherwise become those of the image's /
+    injected = Path(scratch, 'inject.tar')
+    with tarfile.open(injected, 'w') as tarball:
+      for filename, content in sorted(inject.items()):
+        buffer = make_buffer(content)
+        member = tarfile.TarInfo(filename)
+        member.size = len(buffer.getvalue())
+        tarball.addfile(member, buffer)
+
+    skip_list = Path(scratch, 'skip')
+    with open(skip_list, 'w') as io:
+      for path in hidden_paths(layers, merge_layers(layers), inject):
+        io.write(f"/{path}\n")
+
+    trees = [f"ref={layer_ref(diff_id)}" for diff_id in diff_ids] + [f"tar={injected}"]
+    return capture_output(*ostree_commit_argv(ref, None, metadata, sign_by, trees), f"--skip-list={skip_list}")
+
 
+def repack_layers(ref: str, config: dict, blobs: List[Tuple[str, Optional[IO[bytes]]]], inject: Dict[str, str], metadata: dict, sign_by: str = None, commit_lock: threading.Lock = None, layer_refs: Set[str] = None) -> str:
+  # Layers in layer_refs, which is updated as they're committed, are only
+  # listed rather than committed again
+  diff_ids = config['rootfs']['diff_ids']
+  layers = []
 
-def repack(ref: str, image: str, arch: str, variant: str = None, sign_by: str = None) -> None:
+  for diff_id, (digest, buffer) in zip(diff_ids, blobs):
+    if buffer is None:
+      # Committed by an earlier repack
+      layers.append(LayerListing(digest, ostree_ls(layer_ref(diff_id))))
+      continue
+
+    with commit_lock:
+      if layer_refs is None or layer_ref(diff_id) not in layer_refs:
+        ostree_commit_layer(diff_id, buffer)
+        if layer_refs is not None:
+          layer_refs.add(layer_ref(diff_id))
+    layers.append(layer_listing(buffer, digest))
+
+  with commit_lock:
+    return ostree_commit_layers(ref, layers, diff_ids, inject, metadata, sign_by)
+
+
+def repack(ref: str, image: str, arch: str, variant: str = None, sign_by: str = None, jobs: int = PULL_JOBS, cache: LayerCache = None, stream: bool = True, commit_lock: threading.Lock = None, manifest_cache: ManifestCache = None, index: Dict[str, dict] = None, layered: bool = False, manifest: dict = None, pool: LayerPool = None, layer_refs: Set[str] = None) -> str:
+  # manifest, if given, is the entry for arch and variant from the image's
+  # manifest list, resolved already
   qualified = qualify_image(image)
-  metadata = registry_manifest(qualified, arch, variant)
+  metadata = dict(manifest) if manifest is not None else registry_manifest(qualified, arch, variant, manifest_cache)
   with_digest = f"{qualified.rsplit(':', 1)[0]}@{metadata['digest']}"
 
-  if ostree_digest(ref) == metadata['digest']:
+  if index is None:
+    index = ostree_index()
+
+  existing = index.get(ref)
+  if existing is not None and existing['schema'] == str(SCHEMA_VERSION) and existing['digest'] == metadata['digest']:
     sys.stderr.write(f"SKIPPED: {ref} already contains {with_digest}\n")
-    print(ostree_rev_parse(ref))
-    return
+    return existing['commit']
+
+  skip = None
+  if layered:
+    refs = layer_refs if layer_refs is not None else ostree_refs()
+    skip = lambda diff_id: layer_ref(diff_id) in refs
 
-  capture_output(EXPORT_COMMAND, 'pull', '--quiet', with_digest)
-  inspect = capture_json(EXPORT_COMMAND, 'image', 'inspect', with_digest)
+  config, blobs = pull_image(qualified, metadata['digest'], jobs, cache, skip=skip, pool=pool)
 
   metadata["source"] = image
   metadata["qualified"] = qualified
   metadata["imported"] = datetime.datetime.now().isoformat()
-  metadata["config"] = inspect[0]["Config"]
+  metadata["config"] = config.get("config") or {}
+  metadata["diff_ids"] = config['rootfs']['diff_ids']
   metadata[SCHEMA_KEY] = SCHEMA_VERSION
 
-  tarball = tempfile.NamedTemporaryFile(suffix='.tar', delete=False)
+  inject = {METADATA_FILENAME: json.dumps(metadata, indent=2)}
+
+  if commit_lock is None:
+    commit_lock = nullcontext()
+
   try:
-    export_rootfs(with_digest, tarball, inject={METADATA_FILENAME: json.dumps(metadata, indent=2)})
-    commit = ostree_commit(ref, tarball.name, metadata, sign_by)
-    sys.stderr.write(f"SUCCESS: {with_digest} imported to {ref}\n")
-    print(commit)
+    commit = None
+    if layered:
+      try:
+        commit = repack_layers(ref, config, blobs, inject, metadata, sign_by, commit_lock, layer_refs)
+      except subprocess.CalledProcessError as error:
+        # Some layers weren't downloaded, and the rest were used up
+        sys.stderr.write(f"NOTICE: couldn't compose layer commits, flattening instead; {error}\n")
+        config, blobs = pull_image(qualified, metadata['digest'], jobs, cache, pool=pool)
+
+    if commit is None:
+      layers = [Layer(buffer, digest) for digest, buffer in blobs]
+      if stream:
+        with commit_lock:
+          commit = ostree_commit_stream(ref, lambda output: export_layers(layers, output, inject), metadata, sign_by)
+      else:
+        tarball = tempfile.NamedTemporaryFile(suffix='.tar', delete=False)
+        try:
+          export_layers(layers, tarball, inject)
+          with commit_lock:
+            commit = ostree_commit(ref, tarball.name, metadata, sign_by)
+        finally:
+          os.unlink(tarball.name)
   finally:
-    os.unlink(tarball.name)
+    if cache is not None:
+      cache.prune()
+
+  if cache is not None:
+    sys.stderr.write(f"CACHE: {cache.hits} hits, {cache.misses} misses pulling {with_digest}\n")
+  sys.stderr.write(f"SUCCESS: {with_digest} imported to {ref}\n")
+  return commit
+
+
+def ostree_static_delta(from_sha: Optional[str], to_sha: str) -> int:
+  # Generates a delta unless it's there already, and returns its size
+  path = ostree_delta_path(from_sha, to_sha)
+  if not path.joinpath('superblock').exists():
+    argv = ['ostree', 'static-delta', 'generate', f"--to={to_sha}"]
+    argv.append('--empty' if from_sha is None else f"--from={from_sha}")
+    subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+
+  return sum(entry.stat().st_size for entry in path.iterdir() if entry.is_file()) if path.is_dir() else 0
+
+
+def generate_deltas(ref: str, commit: str, depth: int = DELTA_DEPTH, budget: int = None) -> List[str]:
+  # A delta from scratch, for devices that don't have the branch yet, and
+  # one from each of the last depth commits, nearest first, for as long as
+  # those fit in budget; anything else pulls object by object
+  deltas = [commit]
+  size = ostree_static_delta(None, commit)
+  total = 0
+
+  for parent in ostree_ancestors(commit, depth):
+    delta = f"{parent}-{commit}"
+    delta_size = ostree_static_delta(parent, commit)
+    if budget is not None and total + delta_size > budget:
+      subprocess.run(['ostree', 'static-delta', 'delete', delta], stdout=subprocess.DEVNULL, check=True)
+      sys.stderr.write(f"NOTICE: delta {delta} for {ref} is over budget, not keeping it or any older ones\n")
+      break
+    deltas.append(delta)
+    total += delta_size
+
+  sys.stderr.write(f"DELTAS: {len(deltas) - 1} from earlier commits ({total} bytes) and 1 from scratch ({size} bytes) to {ref}\n")
+  return deltas
+
+
+def ostree_update_summary(sign_by: str = None) -> None:
+  # Lists refs and deltas for clients, so they know which deltas they can use
+  argv = ['ostree', 'summary', '--update']
+  if sign_by is not None:
+    argv.append(f"--gpg-sign={sign_by}")
+  subprocess.run(argv, check=True)
+
+
+def publish_deltas(commits: Dict[str, str], depth: int = DELTA_DEPTH, budget: int = None, sign_by: str = None) -> None:
+  for ref, commit in sorted(commits.items()):
+    generate_deltas(ref, commit, depth, budget)
+  ostree_update_summary(sign_by)
+
+
+def load_batch(path: str, arch: str = None, variant: str = None) -> List[dict]:
+  with open(path) as io:
+    entries = json.load(io)
+
+  if not isinstance(entries, list):
+    raise RuntimeError(f"{path} should contain a list of images to import")
+
+  for index, entry in enumerate(entries):
+    for key in ['branch', 'image']:
+      if key not in entry:
+        raise RuntimeError(f"Entry {index} in {path} has no {key}")
+
+    entry.setdefault('arch', arch)
+    entry.setdefault('variant', variant)
+    if entry['arch'] is None:
+      raise RuntimeError(f"Entry {index} in {path} has no arch, and --arch not specified and PODRACER_ARCH not set")
+
+  return entries
+
+
+def repack_batch(entries: List[dict], sign_by: str = None, jobs: int = PULL_JOBS, cache_size: int = 0, workers: int = BATCH_WORKERS, manifest_cache: ManifestCache = None, layered: bool = False, commits: Dict[str, str] = None, stream: bool = False) -> int:
+  # Imports run side by side, but only one of them commits at a time; layers
+  # they have in common are downloaded, and with layered committed, once.
+  # Branches that were imported are added to commits, if given. A streamed
+  # export holds the commit lock throughout, so by default each image is
+  # exported to a temporary file and only its commit waits for the others
+  commit_lock = threading.Lock()
+  index = ostree_index()
+  pool = LayerPool()
+  layer_refs = set(ostree_refs()) if layered else None
+  failures = 0
+
+  def repack_entry(entry: dict) -> str:
+    # Each import gets its own view of the cache so hit counts stay per-ref
+    cache = LayerCache(max_size=cache_size) if cache_size > 0 else None
+    return repack(entry['branch'], entry['image'], entry['arch'], entry['variant'], sign_by=sign_by, jobs=jobs, cache=cache, stream=stream,
+                  commit_lock=commit_lock, manifest_cache=manifest_cache, index=index, layered=layered, manifest=entry.get('manifest'),
+                  pool=pool, layer_refs=layer_refs)
+
+  try:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = {executor.submit(repack_entry, entry): entry for entry in entries}
+      for future in as_completed(futures):
+        entry = futures[future]
+        try:
+          commit = future.result()
+          print(f"{commit} {entry['branch']}")
+          if commits is not None:
+            commits[entry['branch']] = commit
+        except Exception as error:
+          sys.stderr.write(f"FAILED: {entry['image']} not imported to {entry['branch']}: {error}\n")
+          failures += 1
+  finally:
+    pool.close()
+
+  return 1 if failures > 0 else 0
 
 
 def main(argv: List[str] = sys.argv[1:]) -> int:
   parser = argparse.ArgumentParser(description='Import a container into ostree from a registry')
-  parser.add_argument('ref', metavar='BRANCH', help='ostree branch to commit to')
-  parser.add_argument('image', metavar='IMAGE', help='image to import')
+  parser.add_argument('ref', metavar='BRANCH', nargs='?', help='ostree branch to commit to')
+  parser.add_argument('image', metavar='IMAGE', nargs='?', help='image to import')
   parser.add_argument('--repo', metavar='OSTREE', help='ostree repo to import to')
   parser.add_argument('--sign-by', metavar='KEYID', help='sign commit with GPG key')
   parser.add_argument('--arch', metavar='ARCH', help='architecture to import')
   parser.add_argument('--variant', metavar='VARIANT', help='variant to import')
+  parser.add_argument('--platforms', metavar='ARCH[/VARIANT],...', help='import each of these platforms to BRANCH/ARCH[/VARIANT]')
+  parser.add_argument('--all-platforms', action='store_true', help='import every linux platform of the image to BRANCH/ARCH[/VARIANT]')
+  parser.add_argument('--jobs', metavar='N', type=int, default=PULL_JOBS, help=f"layers to download at once (default {PULL_JOBS})")
+  parser.add_argument('--cache-size', metavar='SIZE', default=LAYER_CACHE_SIZE, help=f"size limit of the layer cache, 0 to disable (default {LAYER_CACHE_SIZE})")
+  parser.add_argument('--no-stream', action='store_true', help='export to a temporary file before committing')
+  parser.add_argument('--layer-commits', action='store_true', help='commit each layer once, and compose the image from layer commits')
+  parser.add_argument('--deltas', action='store_true', help='generate static deltas to each commit, then update the summary')
+  parser.add_argument('--delta-depth', metavar='N', type=int, default=DELTA_DEPTH, help=f"with --deltas, earlier commits to generate deltas from (default {DELTA_DEPTH})")
+  parser.add_argument('--delta-budget', metavar='SIZE', help='with --deltas, most space the deltas from earlier commits may take for each new commit')
+  parser.add_argument('--no-manifest-cache', action='store_true', help='always download manifests, even if the tag is unchanged')
+  parser.add_argument('--batch', metavar='FILE', help='import every branch and image listed in a JSON file')
+  parser.add_argument('--workers', metavar='N', type=int, default=BATCH_WORKERS, help=f"images or platforms to import at once (default {BATCH_WORKERS})")
   args = parser.parse_args(argv)
 
-  if args.arch is None:
+  if args.batch is not None:
+    if args.ref is not None or args.image is not None:
+      parser.error('BRANCH and IMAGE cannot be used with --batch')
+  elif args.ref is None or args.image is None:
+    parser.error('BRANCH and IMAGE are required unless --batch is given')
+
+  platforms = None
+  if args.platforms is not None or args.all_platforms:
+    if args.platforms is not None and args.all_platforms:
+      parser.error('--platforms and --all-platforms cannot be used together')
+    if args.batch is not None or args.arch is not None or args.variant is not None:
+      parser.error('--arch, --variant and --batch cannot be used with --platforms or --all-platforms')
+    if args.platforms is not None:
+      platforms = parse_platforms(args.platforms)
+  elif args.arch is None:
     if 'PODRACER_ARCH' in os.environ and len(os.environ['PODRACER_ARCH']) > 0:
       args.arch = os.getenv('PODRACER_ARCH')
-    else:
+    elif args.batch is None:
       raise RuntimeError('--arch not specified and PODRACER_ARCH not set')
 
-  if args.variant is None:
+  if args.variant is None and not args.all_platforms and args.platforms is None:
     if 'PODRACER_VARIANT' in os.environ and len(os.environ['PODRACER_VARIANT']) > 0:
       args.variant = os.getenv('PODRACER_VARIANT')
 
@@ -128,8 +459,40 @@ def main(argv: List[str] = sys.argv[1:]) -> int:
     else:
       raise RuntimeError("Couldn't read ostree repo; try setting OSTREE_REPO or passing --repo.")
 
-  repack(args.ref, args.image, args.arch, args.variant, args.sign_by)
-  return 0
+  cache = None
+  cache_size = parse_size(args.cache_size)
+  if cache_size > 0:
+    try:
+      cache = LayerCache(max_size=cache_size)
+    except OSError as error:
+      sys.stderr.write(f"NOTICE: layer cache disabled; {error}\n")
+      cache_size = 0
+
+  manifest_cache = None
+  if not args.no_manifest_cache:
+    try:
+      manifest_cache = ManifestCache()
+    except OSError as error:
+      sys.stderr.write(f"NOTICE: manifest cache disabled; {error}\n")
+
+  commits = {}
+  if args.batch is not None:
+    entries = load_batch(args.batch, args.arch, args.variant)
+    status = repack_batch(entries, args.sign_by, args.jobs, cache_size, args.workers, manifest_cache, args.layer_commits, commits)
+  elif args.all_platforms or platforms is not None:
+    entries = platform_entries(args.ref, args.image, platforms, manifest_cache)
+    status = repack_batch(entries, args.sign_by, args.jobs, cache_size, args.workers, manifest_cache, args.layer_commits, commits)
+  else:
+    commits[args.ref] = repack(args.ref, args.image, args.arch, args.variant, sign_by=args.sign_by, jobs=args.jobs, cache=cache, stream=not args.no_stream,
+                               manifest_cache=manifest_cache, layered=args.layer_commits)
+    print(commits[args.ref])
+    status = 0
+
+  if args.deltas and len(commits) > 0:
+    budget = parse_size(args.delta_budget) if args.delta_budget is not None else None
+    publish_deltas(commits, args.delta_depth, budget, args.sign_by)
+
+  return status
 
 
 if __name__ == "__main__":
@@ -9,10 +9,12 @@ import tempfile
 from pathlib import Path
 from typing import Dict, Iterable, List
 from podracer.paths import PODRACER_RUNDIR
-from podracer.ostree import ostree_checkout
+from podracer.daemon import daemon_acquire
+from podracer.ostree import CHECKOUT_ROOT, ostree_checkout_commit, ostree_rev_parse
 from podracer.overlay import podracer_overlay
 from podracer.poststop import poststop
 from podracer.signals import forward_signals
+from podracer.trace import Trace
 
 FORWARD_SIGNALS = [signal.SIGHUP, signal.SIGINT, signal.SIGQUIT, signal.SIGTERM]
 
@@ -37,6 +39,7 @@ class Runner:
     self.env = {"PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"}
     self.entrypoint = []
     self.command = []
+    self.child = None
 
     self.load_config()
     if entrypoint is not None:
@@ -99,31 +102,46 @@ class Runner:
     self.child.send_signal(signum)
 
 
-  def run(self, overlay: bool = True, detach: bool = False) -> int:
-    PODRACER_RUNDIR.mkdir(mode=0o755, parents=True, exist_ok=True)
-    rundir = Path(tempfile.mkdtemp(dir=PODRACER_RUNDIR))
+  def run(self, overlay: bool = True, detach: bool = False, rundir: Path = None, trace: Trace = None) -> int:
+    if trace is None:
+      trace = Trace()
+
+    prepared = rundir is not None
+    if not prepared:
+      PODRACER_RUNDIR.mkdir(mode=0o755, parents=True, exist_ok=True)
+      rundir = Path(tempfile.mkdtemp(dir=PODRACER_RUNDIR))
 
     try:
-      if overlay:
-        self.rootfs, hooks = podracer_overlay(rundir, self.rootfs)
+      if prepared:
+        # podracerd already mounted the overlay and wrote the cleanup hook
+        self.rootfs = rundir.joinpath('rootfs')
+        self.passthru_args += ['--hooks-dir', str(rundir.joinpath('hooks'))]
+      elif overlay:
+        with trace.phase('mount'):
+          self.rootfs, hooks = podracer_overlay(rundir, self.rootfs)
         self.passthru_args += ['--hooks-dir', str(hooks)]
 
       if detach:
         self.passthru_args.append('--detach')
 
-      env_file = rundir.joinpath('env')
-      with open(env_file, 'w') as io:
-        for key, value in self.env.items():
-          io.write(f"{key}={value}\n")
+      with trace.phase('env'):
+        env_file = rundir.joinpath('env')
+        with open(env_file, 'w') as io:
+          for key, value in self.env.items():
+            io.write(f"{key}={value}\n")
 
       argv = ['podman', 'run', '--env-file', str(env_file)] + self.podman_args()
 
-      with forward_signals(self.send_signal, *FORWARD_SIGNALS):
-        self.child = subprocess.Popen(argv)
-        self.child.wait()
+      # Without --detach, this lasts as long as the container does
+      with trace.phase('exec', detach=detach) as phase:
+        with forward_signals(self.send_signal, *FORWARD_SIGNALS):
+          self.child = subprocess.Popen(argv)
+          self.child.wait()
+        phase['status'] = self.child.returncode
     finally:
-      if rundir.exists() and ((self.child.returncode != 0) or (not detach)):
-        poststop(rundir)
+      if rundir.exists() and ((self.child is None) or (self.child.returncode != 0) or (not detach)):
+        with trace.phase('teardown'):
+          poststop(rundir)
 
     return self.child.returncode
 
@@ -147,14 +165,18 @@ def main(argv: List[str] = sys.argv[1:]) -> int:
   parser.add_argument('--replace', action='store_true', help='if a container with the same name exists, replace it')
   parser.add_argument('--rm', action='store_true', help='remove container after exit')
   parser.add_argument('-t', '--tty', action='store_true', help='allocate a pseudo-TTY for container')
+  parser.add_argument('--trace', metavar='FILE', default=os.environ.get('PODRACER_TRACE'), help='append the time spent in each phase of the run to FILE as JSON lines')
   parser.add_argument('-v', '--volume', metavar='VOLUME', action='append', help='bind mount a volume into the container')
   args = parser.parse_args(argv)
 
-  # Checkout the ostree, if needed
-  rootfs = args.rootfs[0]
-  if not args.no_ostree:
-    rootfs = ostree_checkout(rootfs)
+  trace = Trace(args.trace, rootfs=args.rootfs[0])
+  try:
+    return run_container(args, trace)
+  finally:
+    trace.write()
+
 
+def run_container(args: argparse.Namespace, trace: Trace) -> int:
   # Build the environment
   env = {}
 
@@ -202,8 +224,35 @@ def main(argv: List[str] = sys.argv[1:]) -> int:
     if args.tty or args.interactive:
       raise RuntimeError("--detach is incompatible with --tty and --interactive")
 
-  runner = Runner(rootfs, *args.command, entrypoint=args.entrypoint, env=env, passthru_args=passthru_args)
-  return runner.run(detach=args.detach)
+  # Checkout the ostree, if needed, once the arguments check out; podracerd
+  # may have an overlay ready, which is ours to tear down from here on
+  rootfs = args.rootfs[0]
+  rundir = None
+  if not args.no_ostree:
+    with trace.phase('daemon') as phase:
+      try:
+        rundir = daemon_acquire(rootfs)
+      except (OSError, RuntimeError) as error:
+        sys.stderr.write(f"NOTICE: not using podracerd; {error}\n")
+      phase['hit'] = rundir is not None
+
+    if rundir is not None:
+      rootfs = rundir.joinpath('rootfs')
+    else:
+      with trace.phase('resolve'):
+        sha = ostree_rev_parse(rootfs)
+      with trace.phase('checkout', commit=sha) as phase:
+        phase['hit'] = CHECKOUT_ROOT.joinpath(sha).is_dir()
+        rootfs = ostree_checkout_commit(sha)
+
+  try:
+    with trace.phase('config'):
+      runner = Runner(rootfs, *args.command, entrypoint=args.entrypoint, env=env, passthru_args=passthru_args)
+  except:
+    if rundir is not None:
+      poststop(rundir)
+    raise
+  return runner.run(detach=args.detach, rundir=rundir, trace=trace)
 
 
 if __name__ == "__main__":
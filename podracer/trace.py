@@ -0,0 +1,46 @@
+import json
+import os
+import time
+import uuid
+
+from contextlib import contextmanager
+from typing import Iterator, List
+
+
+class Trace:
+  # Times the phases of a run, and appends them to a file as JSON lines once
+  # the run is over; without a path it only keeps time
+  def __init__(self, path: str = None, **fields):
+    self.path = path
+    self.fields = {'run': uuid.uuid4().hex, 'time': time.time(), **fields}
+    self.start = time.monotonic()
+    self.phases: List[dict] = []
+
+
+  @contextmanager
+  def phase(self, name: str, **fields) -> Iterator[dict]:
+    # Callers can add to the yielded dict, e.g. whether a cache was hit
+    record = {'phase': name, 'start': time.monotonic() - self.start, **fields}
+    try:
+      yield record
+    except BaseException as error:
+      record['error'] = type(error).__name__
+      raise
+    finally:
+      record['seconds'] = time.monotonic() - self.start - record['start']
+      self.phases.append(record)
+
+
+  def write(self) -> None:
+    if self.path is None:
+      return
+
+    total = {'phase': 'total', 'start': 0.0, 'seconds': time.monotonic() - self.start}
+    lines = ''.join(json.dumps({**self.fields, **record}) + '\n' for record in self.phases + [total])
+
+    # One write, so lines from concurrent runs don't interleave
+    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, lines.encode())
+    finally:
+      os.close(fd)
@@ -13,9 +13,13 @@ setuptools.setup(
   entry_points = {
     'console_scripts': [
       'podracer-export=podracer.export:main',
+      'podracer-gc=podracer.collect:main',
       'podracer-manifests=podracer.manifests:main',
+      'podracer-prune=podracer.prune:main',
+      'podracer-refs=podracer.refs:main',
       'podracer-run=podracer.run:main',
       'podracer-repack=podracer.repack:main',
+      'podracerd=podracer.daemon:main',
     ]
   }
 )
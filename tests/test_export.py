@@ -0,0 +1,48 @@
+import gzip
+import io
+import json
+import tarfile
+
+import pytest
+
+from podracer.export import Image, export_directory, export_layers
+
+FILES = {'bin/x': b'\x7fELF' + bytes(range(256)) * 64, 'etc/hello': b'hello, world\n'}
+
+
+def tar_bytes(files, compress=False):
+  buffer = io.BytesIO()
+  with tarfile.open(fileobj=buffer, mode='w') as archive:
+    for name, content in files.items():
+      member = tarfile.TarInfo(name)
+      member.size = len(content)
+      archive.addfile(member, io.BytesIO(content))
+  return gzip.compress(buffer.getvalue()) if compress else buffer.getvalue()
+
+
+@pytest.fixture(params=['plain', 'gzipped layer', 'gzipped archive'])
+def archive(request, tmp_path):
+  layer = tar_bytes(FILES, compress=request.param == 'gzipped layer')
+  manifest = json.dumps([{'Config': 'config.json', 'Layers': ['layer/layer.tar']}]).encode()
+
+  path = tmp_path.joinpath('image.tar')
+  path.write_bytes(tar_bytes({'manifest.json': manifest, 'layer/layer.tar': layer}, compress=request.param == 'gzipped archive'))
+  return str(path)
+
+
+def test_export_layers(archive, tmp_path):
+  image = Image(archive=archive)
+  output = tmp_path.joinpath('rootfs.tar')
+  with open(output, 'wb') as buffer:
+    export_layers(image.layers, buffer)
+
+  with tarfile.open(output) as rootfs:
+    assert {name: rootfs.extractfile(name).read() for name in rootfs.getnames()} == FILES
+
+
+def test_export_directory(archive, tmp_path):
+  image = Image(archive=archive)
+  export_directory(image.layers, tmp_path.joinpath('rootfs'))
+
+  for name, content in FILES.items():
+    assert tmp_path.joinpath('rootfs', name).read_bytes() == content
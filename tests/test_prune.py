@@ -0,0 +1,106 @@
+import time
+
+import podracer.ostree
+import podracer.prune
+import pytest
+
+from podracer.ostree import METADATA_PREFIX, ostree_history, ostree_refs
+from podracer.prune import PIN_REF_PREFIX, prune
+
+
+def sha(name):
+  return (name * 64)[:64]
+
+
+class FakeRepo:
+  # Just enough of an ostree repo for podracer-prune: ref files and empty
+  # commit objects on disk, with the decoded commits kept in memory
+  def __init__(self, root):
+    self.root = root
+    self.commits = {}
+
+  def commit_path(self, commit):
+    return self.root.joinpath('objects', commit[:2], f"{commit[2:]}.commit")
+
+  def add(self, commit, parent, age, metadata):
+    self.commits[commit] = {'parent': parent, 'timestamp': int(time.time() - age), 'metadata': metadata}
+    self.commit_path(commit).parent.mkdir(parents=True, exist_ok=True)
+    self.commit_path(commit).touch()
+
+  def ref(self, ref, commit):
+    path = self.root.joinpath('refs', 'heads', ref)
+    if commit is None:
+      path.unlink()
+    else:
+      path.parent.mkdir(parents=True, exist_ok=True)
+      path.write_text(commit)
+
+  def read_commit(self, commit, repo=None):
+    if not self.commit_path(commit).exists():
+      raise FileNotFoundError(commit)
+    return self.commits[commit]
+
+  def run(self, argv, **kwargs):
+    if argv[:3] == ['ostree', 'refs', '--delete']:
+      self.ref(argv[3], None)
+    elif argv[:2] == ['ostree', 'refs']:
+      self.ref(argv[2][len('--create='):], argv[3])
+    elif argv[:2] == ['ostree', 'prune']:
+      depths = dict(arg[len('--retain-branch-depth='):].rsplit('=', 1) for arg in argv if arg.startswith('--retain-branch-depth='))
+      reachable = set()
+      for ref, commit in ostree_refs().items():
+        depth = int(depths[ref]) if ref in depths else None
+        reachable.update(commit for commit, _ in ostree_history(commit, depth))
+      for commit in self.commits:
+        if commit not in reachable and self.commit_path(commit).exists():
+          self.commit_path(commit).unlink()
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+  repo = FakeRepo(tmp_path)
+  monkeypatch.setenv('OSTREE_REPO', str(tmp_path))
+  monkeypatch.setattr(podracer.ostree, 'ostree_read_commit', repo.read_commit)
+  monkeypatch.setattr(podracer.prune, 'ostree_read_commit', repo.read_commit)
+  monkeypatch.setattr(podracer.prune.subprocess, 'run', repo.run)
+  return repo
+
+
+def test_pins_survive_repeated_prunes(repo):
+  # apps/web: a <- b <- c <- d, newest first, each made from its own layer
+  history = 'abcd'
+  for position, name in enumerate(history):
+    parent = sha(history[position + 1]) if position + 1 < len(history) else None
+    repo.add(sha(name), parent, position * 86400, {
+      METADATA_PREFIX + 'digest': f"sha256:{name}",
+      METADATA_PREFIX + 'diff-ids': f"sha256:{name}1",
+    })
+    repo.add(sha(str(position)), None, 86400, {})
+    repo.ref(f"podracer/layers/sha256/{name}1", sha(str(position)))
+  repo.ref('apps/web', sha('a'))
+
+  for _ in range(2):
+    prune(keep=1, pins={'sha256:c'})
+
+    refs = ostree_refs()
+    assert refs[PIN_REF_PREFIX + sha('c')] == sha('c')
+    assert repo.commit_path(sha('c')).exists()
+    assert not repo.commit_path(sha('b')).exists()
+    assert not repo.commit_path(sha('d')).exists()
+    assert sorted(ref for ref in refs if ref.startswith('podracer/layers/')) == [
+      'podracer/layers/sha256/a1',
+      'podracer/layers/sha256/c1',
+    ]
+
+
+def test_unpinned_commits_are_released(repo):
+  repo.add(sha('a'), sha('b'), 0, {METADATA_PREFIX + 'digest': 'sha256:a'})
+  repo.add(sha('b'), None, 86400, {METADATA_PREFIX + 'digest': 'sha256:b'})
+  repo.ref('apps/web', sha('a'))
+
+  prune(keep=1, pins={'sha256:b'}, keep_layers=True)
+  assert PIN_REF_PREFIX + sha('b') in ostree_refs()
+
+  prune(keep=1, keep_layers=True)
+  assert PIN_REF_PREFIX + sha('b') not in ostree_refs()
+  assert not repo.commit_path(sha('b')).exists()
@@ -0,0 +1,41 @@
+import io
+import tarfile
+
+from podracer.export import LayerListing, merge_layers
+from podracer.repack import hidden_paths, layer_listing
+
+
+def tar_layer(names):
+  buffer = io.BytesIO()
+  with tarfile.open(fileobj=buffer, mode='w') as archive:
+    for name in names:
+      member = tarfile.TarInfo(name)
+      if name.endswith('/'):
+        member.type = tarfile.DIRTYPE
+      archive.addfile(member, io.BytesIO(b''))
+  buffer.seek(0)
+  return buffer
+
+
+def test_hidden_paths_of_dot_slash_layers():
+  base = layer_listing(tar_layer(['./', './usr/', './usr/bin/', './usr/bin/old', './etc/', './etc/keep']), 'base')
+  top = layer_listing(tar_layer(['./', './usr/', './usr/bin/', './usr/bin/.wh.old', './etc/.wh..wh..opq', './etc/new']), 'top')
+
+  layers = [base, top]
+  assert hidden_paths(layers, merge_layers(layers), {}) == [
+    'etc/.wh..wh..opq',
+    'etc/keep',
+    'usr/bin/.wh.old',
+    'usr/bin/old',
+  ]
+
+
+def test_dot_slash_layers_line_up_with_layer_commits():
+  # The base layer was committed by an earlier run, so is only listed
+  base = LayerListing('base', ['usr', 'usr/bin', 'usr/bin/old', 'usr/bin/sh'])
+  top = layer_listing(tar_layer(['./usr/', './usr/bin/', './usr/bin/.wh.old']), 'top')
+
+  layers = [base, top]
+  files = merge_layers(layers)
+  assert sorted(files) == ['usr', 'usr/bin', 'usr/bin/sh']
+  assert hidden_paths(layers, files, {}) == ['usr/bin/.wh.old', 'usr/bin/old']